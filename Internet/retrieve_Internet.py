@@ -2,9 +2,11 @@
 from typing import List,Tuple
 from langchain_core.documents import Document
 from model.Internet.Internet_service import retrieve
+from rag.context_packer import INSTANCE as CONTEXT_PACKER
 
 def format_docs(docs:List[Document]):
-    return "\n-------------分割线--------------\n".join(doc.page_content for doc in docs)
+    # 与知识库共用同一个token预算
+    return CONTEXT_PACKER.pack(docs)
 
 def retrieve_html(question:str)->Tuple[List[Document],str]:
     docs = retrieve(question) # 这里的到的是文件
@@ -4,8 +4,10 @@ from qa.question_parser import parse_question
 from qa.function_tool import process_image_describe_tool
 from qa.purpose_type import userPurposeType
 from audio.audio_generate import audio_generate
+from model.Embedding.embedding_provider import INSTANCE as EMBEDDING_PROVIDER
+from model.RAG.pdf_extract import INSTANCE as PDF_EXTRACTOR
+from model.RAG.retrieve_model import INSTANCE as RETRIEVE_MODEL
 
-import PyPDF2
 import chardet
 import mimetypes
 import gradio as gr
@@ -56,13 +58,9 @@ def audio_to_text(audio_file_path):
     return text_simplified
 
 
-# pip install PyPDF2
 def pdf_to_str(pdf_file):
-    reader = PyPDF2.PdfReader(pdf_file)
-    text = ""
-    for page in reader.pages:
-        text += page.extract_text()
-    return text
+    # 页数多时按页并行提取，同一个文件再次上传时直接读取缓存
+    return PDF_EXTRACTOR.extract_text(pdf_file)
 
 
 def docx_to_str(file_path):
@@ -559,6 +557,10 @@ with gr.Blocks() as demo:
 
 # 启动应用
 def start_gradio():
+    # 在后台线程中预热编码模型，界面无需等待模型加载完成
+    EMBEDDING_PROVIDER.warm_up()
+    # 配置中启用时监听知识库目录和用户文件夹
+    RETRIEVE_MODEL.start_watching()
     demo.launch(server_port=10032, share=False)
 
 
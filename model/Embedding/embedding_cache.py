@@ -0,0 +1,157 @@
+'''文本向量的磁盘缓存：以 (模型名称, 文本哈希) 为键保存向量，重复出现的文本块不再重新编码'''
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# SQLite 单条语句中参数个数的上限较小，批量查询时分段进行
+_QUERY_BATCH = 500
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache(object):
+    """基于SQLite的向量缓存，总大小超过上限时按最近访问时间淘汰"""
+
+    def __init__(self, path: str, max_size_mb: int):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._max_bytes = max_size_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding ("
+            " model TEXT NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " accessed REAL NOT NULL,"
+            " PRIMARY KEY (model, hash))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embedding_accessed ON embedding (accessed)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(unique), _QUERY_BATCH):
+                part = unique[i : i + _QUERY_BATCH]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embedding WHERE model = ? AND hash IN ({placeholders})",
+                    [model, *part],
+                ).fetchall()
+                for hash, vector in rows:
+                    found[hash] = np.frombuffer(vector, dtype=np.float32).tolist()
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE embedding SET accessed = ? WHERE model = ? AND hash = ?",
+                        [(now, model, hash) for hash, _ in rows],
+                    )
+            self._conn.commit()
+        self.hits += sum(1 for h in hashes if h in found)
+        self.misses += sum(1 for h in hashes if h not in found)
+        return found
+
+    def put_many(self, model: str, items: Dict[str, List[float]]):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding (model, hash, vector, accessed) VALUES (?, ?, ?, ?)",
+                [
+                    (model, hash, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                    for hash, vector in items.items()
+                ],
+            )
+            self._conn.commit()
+            self._evict()
+
+    def _size(self) -> int:
+        page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        freelist = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist) * page_size
+
+    def _evict(self):
+        # 超过上限时删除最久未访问的条目，直到降到上限的九成以下
+        size = self._size()
+        if size <= self._max_bytes:
+            return
+        count = self._conn.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+        if count == 0:
+            return
+        target = int(self._max_bytes * 0.9)
+        remove = max(1, int(count * (1 - target / size)))
+        self._conn.execute(
+            "DELETE FROM embedding WHERE rowid IN ("
+            " SELECT rowid FROM embedding ORDER BY accessed LIMIT ?)",
+            (remove,),
+        )
+        self._conn.commit()
+        print(f"向量缓存超过 {self._max_bytes // 1024 // 1024}MB，已淘汰 {remove} 条")
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class CachedEmbeddings(Embeddings):
+    """包装一个编码模型，编码文档前先查询缓存，只对未命中的文本调用模型"""
+
+    def __init__(self, embedding: Embeddings, model_name: str, cache: EmbeddingCache):
+        self._embedding = embedding
+        self._model_name = model_name
+        self._cache = cache
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(text) for text in texts]
+        found = self._cache.get_many(self._model_name, hashes)
+
+        missing: Dict[str, str] = {}
+        for hash, text in zip(hashes, texts):
+            if hash not in found and hash not in missing:
+                missing[hash] = text
+        if missing:
+            vectors = self._embedding.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._cache.put_many(self._model_name, computed)
+            found.update(computed)
+
+        return [found[hash] for hash in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embedding.embed_query(text)
+
+
+_CACHE: Optional[EmbeddingCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_embedding_cache(path: str, max_size_mb: int) -> EmbeddingCache:
+    """进程内共享同一个缓存连接"""
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = EmbeddingCache(path, max_size_mb)
+        return _CACHE
@@ -0,0 +1,125 @@
+'''进程内共享的编码模型：首次使用时才加载，也可以在后台线程中提前预热'''
+import os
+import time
+import shutil
+import threading
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_community.embeddings import ModelScopeEmbeddings
+from modelscope.hub.snapshot_download import snapshot_download
+
+from config.config import Config
+from model.model_base import ModelStatus
+from model.Embedding.embedding_cache import CachedEmbeddings, get_embedding_cache
+from model.Embedding.sharded_embedding import ShardedEmbeddings
+
+
+class EmbeddingProvider(Embeddings):
+    """所有检索器共用的编码模型，加载前调用会阻塞直到模型可用"""
+
+    def __init__(self):
+        # 此处请自行改成下载embedding模型的位置
+        self._embedding_download_path = Config.get_instance().get_with_nested_params(
+            "model", "embedding", "model-path"
+        )
+        self._embedding_model_name = Config.get_instance().get_with_nested_params(
+            "model", "embedding", "model-name"
+        )
+        self._embedding_model_path = os.path.join(
+            self._embedding_download_path, self._embedding_model_name
+        )
+        self._model: Optional[Embeddings] = None
+        self._status = ModelStatus.INITIAL
+        self._lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.load_seconds = 0.0
+
+    @property
+    def model_name(self) -> str:
+        return self._embedding_model_name
+
+    @property
+    def status(self) -> ModelStatus:
+        return self._status
+
+    @property
+    def ready(self) -> bool:
+        return self._status == ModelStatus.READY
+
+    def _download(self):
+        if os.path.exists(self._embedding_model_path):
+            return
+        try:
+            # 如果为空，则从modelscope下载模型
+            model_dir = snapshot_download(
+                self._embedding_model_name,
+                cache_dir=self._embedding_download_path,
+            )
+            print(f"Model downloaded and saved to {model_dir}")
+        except Exception as e:
+            print(f"Failed to download model: {e}")
+            if os.path.exists(self._embedding_model_path):
+                shutil.rmtree(self._embedding_model_path)
+
+    def _get_model(self) -> Embeddings:
+        if self._model is not None:
+            return self._model
+        with self._lock:
+            if self._model is None:
+                self._status = ModelStatus.BUILDING
+                start = time.perf_counter()
+                try:
+                    self._download()
+                    self._model = ModelScopeEmbeddings(model_id=self._embedding_model_path)
+                except Exception:
+                    self._status = ModelStatus.FAILED
+                    raise
+                self.load_seconds = time.perf_counter() - start
+                self._status = ModelStatus.READY
+                print(f"编码模型 {self._embedding_model_name} 加载完成，耗时 {self.load_seconds:.1f}s")
+        return self._model
+
+    def start_workers(self, workers: int, threads: int = 1, shard_size: int = 64) -> ShardedEmbeddings:
+        """改为在多个子进程中编码（离线构建索引时使用），每个子进程各自加载模型，本进程不再加载"""
+        with self._lock:
+            self._download()
+            self._model = ShardedEmbeddings(self._embedding_model_path, workers, threads, shard_size)
+            self._status = ModelStatus.READY
+        return self._model
+
+    def warm_up(self) -> threading.Thread:
+        """在后台线程中加载模型，重复调用只会启动一次"""
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._warm_up, name="embedding-warm-up", daemon=True
+                )
+                self._thread.start()
+            return self._thread
+
+    def _warm_up(self):
+        try:
+            self._get_model()
+        except Exception as e:
+            print(f"编码模型预热失败: {e}")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._get_model().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._get_model().embed_query(text)
+
+
+INSTANCE = EmbeddingProvider()
+
+# 带向量缓存的共享编码模型，知识库、用户向量库和联网搜索都使用它
+SHARED_EMBEDDING = CachedEmbeddings(
+    INSTANCE,
+    INSTANCE.model_name,
+    get_embedding_cache(
+        Config.get_instance().get_with_nested_params("model", "embedding", "cache-path"),
+        Config.get_instance().get_with_nested_params("model", "embedding", "cache-size-mb"),
+    ),
+)
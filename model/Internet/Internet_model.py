@@ -5,13 +5,15 @@ from model.model_base import ModelStatus
 import os
 from env import get_app_root
 
-from langchain_community.embeddings import ModelScopeEmbeddings
 from langchain_core.vectorstores import VectorStoreRetriever
-from langchain_community.document_loaders import DirectoryLoader, MHTMLLoader, UnstructuredHTMLLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores.faiss import FAISS
 
 from config.config import Config
+from model.Embedding.embedding_provider import SHARED_EMBEDDING
+from model.RAG.file_manifest import scan_files
+from model.RAG.ingest import ingest_files
+from model.RAG.pipeline import IndexPipeline
+from model.RAG.index_factory import IndexSpec
+from model.RAG.chunker import ChunkSpec
 
 # 检索模型
 class InternetModel(Modelbase):
@@ -21,36 +23,39 @@ class InternetModel(Modelbase):
     def __init__(self,*args,**krgs):
         super().__init__(*args,**krgs)
 
-        # 此处请自行改成下载embedding模型的位置
-        self._embedding_model_path =Config.get_instance().get_with_nested_params("model", "embedding", "model-name")
-        self._text_splitter = RecursiveCharacterTextSplitter
         #self._embedding = OpenAIEmbeddings()
-        self._embedding = ModelScopeEmbeddings(model_id=self._embedding_model_path)
+        # 与知识库共用同一个编码模型和向量缓存
+        self._embedding = SHARED_EMBEDDING
         self._data_path = os.path.join(get_app_root(), "data/cache/internet")
+        self._batch_size = Config.get_instance().get_with_nested_params("model", "embedding", "batch-size")
+        self._index_spec = IndexSpec.from_config()
+        self._search_type = Config.get_instance().get_with_nested_params("model", "embedding", "search-type")
+        self._fetch_k = Config.get_instance().get_with_nested_params("model", "embedding", "fetch-k")
+        self._diversify = Config.get_instance().get_with_nested_params("model", "embedding", "diversify")
+        self._mmr_lambda = Config.get_instance().get_with_nested_params("model", "embedding", "mmr-lambda")
         
         #self._logger: Logger = Logger("rag_retriever")
 
     # 建立向量库
     def build(self):
-        # 加载html文件
-        html_loader = DirectoryLoader(self._data_path, glob="**/*.html", loader_cls=UnstructuredHTMLLoader, silent_errors=True, use_multithreading=True)
-        html_docs = html_loader.load()
+        # 加载html和mhtml文件
+        rel_paths = scan_files(self._data_path, (".html", ".mhtml"))
         
-        mhtml_loader = DirectoryLoader(self._data_path, glob="**/*.mhtml", loader_cls=MHTMLLoader, silent_errors=True, use_multithreading=True)
-        mhtml_docs = mhtml_loader.load()
+        # 分块方式与知识库相同，段落（父块）长度为2000、重叠100
+        text_splitter = ChunkSpec.from_config(chunk_size=2000, chunk_overlap=100).create()
         
-        
-        #合并文档
-        docs =  html_docs + mhtml_docs
-        
-        # 创建一个 RecursiveCharacterTextSplitter 对象，用于将文档分割成块，chunk_size为最大块大小，chunk_overlap块之间可以重叠的大小
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=100)
-        splits = text_splitter.split_documents(docs)
-        
-        # 使用 FAISS 创建一个向量数据库，存储分割后的文档及其嵌入向量
-        vectorstore = FAISS.from_documents(documents=splits, embedding=self._embedding)
+        # 使用 FAISS 创建一个向量数据库，索引类型与知识库使用同一配置
+        pipeline = IndexPipeline(self._embedding, text_splitter, self._batch_size, self._index_spec)
+        # 每次联网搜索都会重建，缓存的网页很少，在当前进程中解析，不为此启动进程池
+        vectorstore, _ = pipeline.run(
+            None, ingest_files(self._data_path, rel_paths, max_workers=1), len(rel_paths)
+        )
         # 将向量存储转换为检索器，设置检索参数 k 为 6，即返回最相似的 6 个文档
-        self._retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
+        search_kwargs = {"k": 6, "fetch_k": self._fetch_k}
+        if self._diversify:
+            # 同一网页相邻文本块重复较多，MMR选出差异大的结果并裁掉重叠部分
+            search_kwargs.update(lambda_mult=self._mmr_lambda, dedup_overlap=True)
+        self._retriever = vectorstore.as_retriever(search_type=self._search_type, search_kwargs=search_kwargs)
         
 
         
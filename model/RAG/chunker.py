@@ -0,0 +1,143 @@
+'''文本分块：按中文句末标点切分的分块器，以及用小块编码检索、返回所在段落的父子分块
+
+编码模型（CoRom）的输入只有512个token，2000字的文本块大部分会被截断，既浪费编码时间又降低召回。
+sentence方式把文本切成约chunk-size字的段落（父块），每个段落再切成约child-size字的小块（子块），
+只有子块参与编码和检索，检索到子块后返回去重后的父块作为资料。
+'''
+import re
+from typing import List, Optional, Tuple, Union
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter, TextSplitter
+
+from config.config import Config
+
+SPLITTER_TYPES = ("recursive", "sentence")
+
+# 句末标点和换行处断句；句末标点后紧跟的右引号、右括号（最多两个，如 。”）属于这一句，在它们之后断开
+_SENTENCE_ENDS = "。！？；!?;"
+_CLOSERS = "”’\"」』）)"
+_SENTENCE_RE = re.compile(
+    rf"(?:(?<=[{_SENTENCE_ENDS}\n])|(?<=[{_SENTENCE_ENDS}][{_CLOSERS}])|(?<=[{_SENTENCE_ENDS}][{_CLOSERS}]{{2}}))"
+    rf"(?![{_CLOSERS}\n])"
+)
+# 句子太长时再按逗号、顿号、冒号断开
+_CLAUSE_RE = re.compile(r"(?<=[，、：,:])")
+
+
+def _split_long(text: str, pattern: re.Pattern, max_len: int) -> List[str]:
+    pieces = []
+    for piece in pattern.split(text):
+        if len(piece) <= max_len:
+            pieces.append(piece)
+        elif pattern is _SENTENCE_RE:
+            pieces.extend(_split_long(piece, _CLAUSE_RE, max_len))
+        else:
+            pieces.extend(piece[i : i + max_len] for i in range(0, len(piece), max_len))
+    return pieces
+
+
+class ChineseSentenceSplitter(TextSplitter):
+    """按句子拼接文本块：每块不超过chunk_size个字，块之间重叠不超过chunk_overlap个字的完整句子
+
+    只有单句超过chunk_size时才在逗号处断开，仍然超过时按长度硬切。
+    """
+
+    def split_text(self, text: str) -> List[str]:
+        pieces = [p for p in _split_long(text, _SENTENCE_RE, self._chunk_size) if p]
+        chunks = []
+        current: List[str] = []
+        length = 0
+        for piece in pieces:
+            if current and length + len(piece) > self._chunk_size:
+                chunk = "".join(current).strip()
+                if chunk:
+                    chunks.append(chunk)
+                # 从上一块末尾取不超过chunk_overlap个字的完整句子作为下一块的开头
+                overlap: List[str] = []
+                overlap_length = 0
+                for previous in reversed(current):
+                    if overlap_length + len(previous) > self._chunk_overlap:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_length += len(previous)
+                if overlap_length + len(piece) > self._chunk_size:
+                    overlap, overlap_length = [], 0
+                current, length = overlap, overlap_length
+            current.append(piece)
+            length += len(piece)
+        chunk = "".join(current).strip()
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+
+class ParentChildSplitter(object):
+    """把文档切成父块，再把每个父块切成子块"""
+
+    def __init__(self, parent: TextSplitter, child: TextSplitter):
+        self.parent = parent
+        self.child = child
+
+    def split_documents(self, docs: List[Document]) -> List[Tuple[Document, List[Document]]]:
+        """返回 (父块, 子块列表)，子块继承父块的metadata"""
+        return [
+            (parent, self.child.split_documents([parent]))
+            for parent in self.parent.split_documents(docs)
+        ]
+
+
+class ChunkSpec(object):
+    """根据配置创建分块器，并生成写入索引清单的分块参数"""
+
+    def __init__(
+        self,
+        splitter_type: str = "sentence",
+        chunk_size: int = 2000,
+        chunk_overlap: int = 100,
+        child_size: int = 256,
+        child_overlap: int = 32,
+    ):
+        if splitter_type not in SPLITTER_TYPES:
+            raise ValueError(f"不支持的分块方式 {splitter_type}，可选 {SPLITTER_TYPES}")
+        self.splitter_type = splitter_type
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.child_size = child_size
+        self.child_overlap = child_overlap
+
+    @classmethod
+    def from_config(
+        cls, chunk_size: Optional[int] = None, chunk_overlap: Optional[int] = None
+    ) -> "ChunkSpec":
+        """chunk_size、chunk_overlap不传时使用知识库的配置"""
+        conf = Config.get_instance().get_with_nested_params("model", "embedding")
+        return cls(
+            splitter_type=conf.get("splitter", "sentence"),
+            chunk_size=chunk_size if chunk_size is not None else conf.get("chunk-size", 2000),
+            chunk_overlap=chunk_overlap if chunk_overlap is not None else conf.get("chunk-overlap", 100),
+            child_size=conf.get("child-size", 256),
+            child_overlap=conf.get("child-overlap", 32),
+        )
+
+    def manifest(self) -> dict:
+        manifest = {
+            "splitter": self.splitter_type,
+            "chunk-size": self.chunk_size,
+            "chunk-overlap": self.chunk_overlap,
+        }
+        if self.splitter_type == "sentence":
+            manifest["child-size"] = self.child_size
+            manifest["child-overlap"] = self.child_overlap
+        return manifest
+
+    def create(self) -> Union[TextSplitter, ParentChildSplitter]:
+        if self.splitter_type == "recursive":
+            # chunk_size为最大块大小，chunk_overlap块之间可以重叠的大小
+            return RecursiveCharacterTextSplitter(
+                chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap
+            )
+        return ParentChildSplitter(
+            ChineseSentenceSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap),
+            ChineseSentenceSplitter(chunk_size=self.child_size, chunk_overlap=self.child_overlap),
+        )
@@ -0,0 +1,309 @@
+'''紧凑的docstore：文本块内容存放在按偏移量寻址的字符串表中，metadata按字段驻留为列式数组
+
+InMemoryDocstore为每个文本块保存一个Document对象和一个metadata字典，文本块很多时这些对象比向量本身还占内存。
+这里的文本连续存放在一个字节串中，metadata的每个字段只保存取值表中的下标，相同的取值（如同一文件的source）只存一份。
+整数（如page、row）直接存放在int64列中；取值几乎各不相同的字段（如记录编号）不进入取值表，
+序列化后与文本一样连续存放，避免取值表随行数增长。
+保存到磁盘后再加载时，字符串表和列以内存映射方式打开，只有检索命中的文本块才会被还原成Document。
+'''
+import os
+import mmap
+import pickle
+from array import array
+from typing import Any, Dict, Hashable, List, Optional, Set, Union
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+TEXTS_FILE = "texts.bin"
+OFFSETS_FILE = "offsets.npy"
+TABLES_FILE = "tables.pkl"
+EXTRAS_FILE = "extras.bin"
+EXTRA_OFFSETS_FILE = "extra-offsets.npy"
+_MISSING = -1
+# 整数列中表示这一行没有该字段
+_NO_INT = np.iinfo(np.int64).min
+_INT_MAX = np.iinfo(np.int64).max
+# 字段的取值表超过这么多项、且不同取值超过该字段出现次数的四分之一时，后续的新取值不再驻留
+_MAX_INTERNED = 4096
+# 知识库以中文为主，UTF-16每个汉字2字节（UTF-8需要3字节），与Python字符串本身的存储方式相当
+_ENCODING = "utf-16-le"
+
+
+class _Unhashable(object):
+    """不可哈希的metadata取值（列表、字典等）序列化后再驻留"""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __eq__(self, other):
+        return isinstance(other, _Unhashable) and self.data == other.data
+
+    def __hash__(self):
+        return hash(self.data)
+
+
+class _Segment(object):
+    """一段连续的行：base为从磁盘映射的只读段，tail为加载后新增的行
+
+    columns为驻留字段的取值下标，ints为整数字段的取值，extras为不驻留的字段序列化后的字节串。
+    """
+
+    def __init__(self, texts, offsets, columns: Dict[str, Any], ints: Dict[str, Any], extras, extra_offsets):
+        self.texts = texts
+        self.offsets = offsets
+        self.columns = columns
+        self.ints = ints
+        self.extras = extras
+        self.extra_offsets = extra_offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text(self, row: int) -> str:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return bytes(self.texts[start:end]).decode(_ENCODING)
+
+    def value_index(self, key: str, row: int) -> int:
+        column = self.columns.get(key)
+        return _MISSING if column is None else int(column[row])
+
+    def int_value(self, key: str, row: int) -> int:
+        column = self.ints.get(key)
+        return _NO_INT if column is None else int(column[row])
+
+    def extra_bytes(self, row: int) -> bytes:
+        start, end = int(self.extra_offsets[row]), int(self.extra_offsets[row + 1])
+        return bytes(self.extras[start:end])
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            len(self.texts)
+            + len(self.offsets) * 8
+            + sum(len(c) * 4 for c in self.columns.values())
+            + sum(len(c) * 8 for c in self.ints.values())
+            + len(self.extras)
+            + len(self.extra_offsets) * 8
+        )
+
+
+def _empty_tail() -> _Segment:
+    return _Segment(bytearray(), array("q", [0]), {}, {}, bytearray(), array("q", [0]))
+
+
+class CompactDocstore(Docstore, AddableMixin):
+    """可增删的紧凑docstore，接口与InMemoryDocstore相同，可直接用于FAISS向量库
+
+    删除只是去掉id到行号的映射，占用的空间在下次保存时回收。
+    """
+
+    def __init__(self):
+        self._rows: Dict[str, int] = {}
+        self._keys: List[str] = []
+        # 每个字段的取值表，以及取值到下标的反查表
+        self._values: Dict[str, List[Any]] = {}
+        self._value_index: Dict[str, Dict[Hashable, int]] = {}
+        # 每个字段以非整数取值出现的次数，以及不再驻留新取值的字段
+        self._counts: Dict[str, int] = {}
+        self._unique_keys: Set[str] = set()
+        self._base = _Segment(b"", np.zeros(1, dtype=np.int64), {}, {}, b"", np.zeros(1, dtype=np.int64))
+        self._tail = _empty_tail()
+        self._mmaps: List[mmap.mmap] = []
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._rows
+
+    @property
+    def nbytes(self) -> int:
+        # id到行号的映射每项约100字节
+        return self._base.nbytes + self._tail.nbytes + len(self._rows) * 100
+
+    def _register(self, key: str):
+        if key not in self._values:
+            self._keys.append(key)
+            self._values[key] = []
+            self._value_index[key] = {}
+            self._counts[key] = 0
+
+    def _intern(self, key: str, value: Any) -> int:
+        """返回取值在取值表中的下标，该字段不再驻留新取值时返回_MISSING"""
+        self._counts[key] += 1
+        try:
+            hash(value)
+        except TypeError:
+            value = _Unhashable(pickle.dumps(value))
+        table = self._values[key]
+        index = self._value_index[key].get(value)
+        if index is not None:
+            return index
+        if key in self._unique_keys:
+            return _MISSING
+        if len(table) >= _MAX_INTERNED and len(table) * 4 > self._counts[key]:
+            # 取值几乎各不相同，驻留只会让取值表随行数增长
+            self._unique_keys.add(key)
+            return _MISSING
+        index = len(table)
+        table.append(value)
+        self._value_index[key][value] = index
+        return index
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        """添加文档，已存在的id会被新内容覆盖（旧内容在下次保存时回收）"""
+        tail = self._tail
+        for id, doc in texts.items():
+            row = len(self._base) + len(tail)
+            tail.texts.extend(doc.page_content.encode(_ENCODING))
+            tail.offsets.append(len(tail.texts))
+            extras = {}
+            for key, value in doc.metadata.items():
+                self._register(key)
+                if type(value) is int and _NO_INT < value <= _INT_MAX:
+                    column = tail.ints.get(key)
+                    if column is None:
+                        column = tail.ints[key] = array("q", [_NO_INT] * (len(tail) - 1))
+                    column.append(value)
+                    continue
+                index = self._intern(key, value)
+                if index == _MISSING:
+                    extras[key] = value
+                    continue
+                column = tail.columns.get(key)
+                if column is None:
+                    column = tail.columns[key] = array("i", [_MISSING] * (len(tail) - 1))
+                column.append(index)
+            # 这一行没有的字段补上缺失标记，保证各列长度一致
+            for key, column in tail.columns.items():
+                if len(column) < len(tail):
+                    column.append(_MISSING)
+            for key, column in tail.ints.items():
+                if len(column) < len(tail):
+                    column.append(_NO_INT)
+            if extras:
+                tail.extras.extend(pickle.dumps(extras))
+            tail.extra_offsets.append(len(tail.extras))
+            self._rows[id] = row
+
+    def delete(self, ids: List) -> None:
+        for id in ids:
+            self._rows.pop(id, None)
+
+    def _segment(self, row: int):
+        if row < len(self._base):
+            return self._base, row
+        return self._tail, row - len(self._base)
+
+    def _metadata(self, segment: _Segment, row: int) -> dict:
+        data = segment.extra_bytes(row)
+        extras = pickle.loads(data) if data else {}
+        metadata = {}
+        for key in self._keys:
+            if key in extras:
+                metadata[key] = extras[key]
+                continue
+            index = segment.value_index(key, row)
+            if index != _MISSING:
+                value = self._values[key][index]
+                if isinstance(value, _Unhashable):
+                    value = pickle.loads(value.data)
+                metadata[key] = value
+                continue
+            value = segment.int_value(key, row)
+            if value != _NO_INT:
+                metadata[key] = value
+        return metadata
+
+    def search(self, search: str) -> Union[str, Document]:
+        row = self._rows.get(search)
+        if row is None:
+            return f"ID {search} not found."
+        segment, row = self._segment(row)
+        return Document(id=search, page_content=segment.text(row), metadata=self._metadata(segment, row))
+
+    def get(self, id: Optional[str], default: Any = None) -> Any:
+        if id is None or id not in self._rows:
+            return default
+        return self.search(id)
+
+    def save(self, path: str):
+        """只写入未删除的行，写完后可用load以内存映射方式打开"""
+        os.makedirs(path, exist_ok=True)
+        ids = list(self._rows)
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        extra_offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        columns = {key: np.full(len(ids), _MISSING, dtype=np.int32) for key in self._keys}
+        ints = {key: np.full(len(ids), _NO_INT, dtype=np.int64) for key in self._keys}
+        with open(os.path.join(path, TEXTS_FILE), "wb") as f, open(os.path.join(path, EXTRAS_FILE), "wb") as e:
+            position = extra_position = 0
+            for i, id in enumerate(ids):
+                segment, row = self._segment(self._rows[id])
+                start, end = int(segment.offsets[row]), int(segment.offsets[row + 1])
+                f.write(segment.texts[start:end])
+                position += end - start
+                offsets[i + 1] = position
+                extra = segment.extra_bytes(row)
+                e.write(extra)
+                extra_position += len(extra)
+                extra_offsets[i + 1] = extra_position
+                for key in self._keys:
+                    columns[key][i] = segment.value_index(key, row)
+                    ints[key][i] = segment.int_value(key, row)
+        np.save(os.path.join(path, OFFSETS_FILE), offsets)
+        np.save(os.path.join(path, EXTRA_OFFSETS_FILE), extra_offsets)
+        # 只写入有取值的列，没有的列加载时视为全部缺失
+        for i, key in enumerate(self._keys):
+            if self._values[key]:
+                np.save(os.path.join(path, f"column-{i}.npy"), columns[key])
+            if (ints[key] != _NO_INT).any():
+                np.save(os.path.join(path, f"int-column-{i}.npy"), ints[key])
+        with open(os.path.join(path, TABLES_FILE), "wb") as f:
+            pickle.dump((ids, self._keys, self._values, self._counts, self._unique_keys), f)
+
+    @classmethod
+    def load(cls, path: str) -> "CompactDocstore":
+        with open(os.path.join(path, TABLES_FILE), "rb") as f:
+            ids, keys, values, counts, unique_keys = pickle.load(f)
+        docstore = cls()
+        docstore._rows = {id: row for row, id in enumerate(ids)}
+        docstore._keys = keys
+        docstore._values = values
+        docstore._counts = counts
+        docstore._unique_keys = unique_keys
+        docstore._value_index = {
+            key: {value: i for i, value in enumerate(table)} for key, table in values.items()
+        }
+        docstore._base = _Segment(
+            docstore._map(os.path.join(path, TEXTS_FILE)),
+            np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r"),
+            docstore._load_columns(path, "column"),
+            docstore._load_columns(path, "int-column"),
+            docstore._map(os.path.join(path, EXTRAS_FILE)),
+            np.load(os.path.join(path, EXTRA_OFFSETS_FILE), mmap_mode="r"),
+        )
+        return docstore
+
+    def _map(self, path: str) -> Union[bytes, mmap.mmap]:
+        if os.path.getsize(path) == 0:
+            return b""
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmaps.append(mapped)
+        return mapped
+
+    def _load_columns(self, path: str, prefix: str) -> Dict[str, np.ndarray]:
+        columns = {}
+        for i, key in enumerate(self._keys):
+            column_path = os.path.join(path, f"{prefix}-{i}.npy")
+            if os.path.exists(column_path):
+                columns[key] = np.load(column_path, mmap_mode="r")
+        return columns
+
+    def __getstate__(self):
+        # 内存映射的内容无法pickle，防止FAISS.save_local等把它整体序列化
+        raise TypeError("CompactDocstore 需要用 save/load 保存和加载")
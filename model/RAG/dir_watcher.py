@@ -0,0 +1,190 @@
+'''目录监听：文件新增、修改、删除后把变化的相对路径合并成一批交给回调，用于近实时地增量更新索引
+
+安装了watchdog时使用系统的文件事件（Linux下为inotify），否则定期扫描目录比较文件的大小和修改时间。
+一批文件连续写入时会产生大量事件，最后一次事件后等待debounce秒没有新变化才回调一次。
+'''
+import os
+import time
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # pip install watchdog
+    FileSystemEventHandler = object
+    Observer = None
+
+# 编辑器和下载工具的临时文件，写完后会被重命名为正式文件
+_TEMP_PREFIXES = (".", "~$")
+_TEMP_SUFFIXES = (".tmp", ".part", ".crdownload", ".swp")
+# 连续不断的变化最多推迟这么多倍的debounce，避免一直不更新
+_MAX_DELAY_FACTOR = 10
+
+
+def _is_temp(rel_path: str) -> bool:
+    name = rel_path.rsplit("/", 1)[-1]
+    return name.startswith(_TEMP_PREFIXES) or name.lower().endswith(_TEMP_SUFFIXES)
+
+
+def _snapshot(root: str) -> Dict[str, Tuple[int, float]]:
+    snapshot = {}
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            full_path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                continue
+            rel_path = os.path.relpath(full_path, root).replace(os.sep, "/")
+            snapshot[rel_path] = (stat.st_size, stat.st_mtime)
+    return snapshot
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher: "DirectoryWatcher"):
+        super().__init__()
+        self._watcher = watcher
+
+    def on_any_event(self, event):
+        # 子文件变化时目录本身也会收到modified事件，只关心文件和目录的增删、移动
+        if event.is_directory and event.event_type == "modified":
+            return
+        if event.event_type not in ("created", "modified", "deleted", "moved", "closed"):
+            return
+        self._watcher.notify(event.src_path)
+        if getattr(event, "dest_path", ""):
+            self._watcher.notify(event.dest_path)
+
+
+class DirectoryWatcher(object):
+    """监听root目录，变化合并后以相对路径列表（"/"分隔）调用on_change
+
+    路径可能是文件，也可能是被创建、删除或移动的目录，由回调自行判断；回调在监听线程中执行，
+    执行期间发生的变化会在回调结束后合并为下一批。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        root: str,
+        on_change: Callable[[List[str]], None],
+        debounce: float = 2.0,
+        poll_interval: float = 5.0,
+    ):
+        self.name = name
+        self.root = os.path.abspath(root)
+        self._on_change = on_change
+        self._debounce = debounce
+        self._poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending: Set[str] = set()
+        self._first_event = 0.0
+        self._last_event = 0.0
+        self._stopped = threading.Event()
+        self._observer = None
+        self._thread: Optional[threading.Thread] = None
+
+        self.batches = 0
+        self.events = 0
+        self.last_batch_at: Optional[float] = None
+
+    @property
+    def backend(self) -> str:
+        return "watchdog" if Observer is not None else "polling"
+
+    def start(self):
+        os.makedirs(self.root, exist_ok=True)
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(_EventHandler(self), self.root, recursive=True)
+            self._observer.daemon = True
+            self._observer.start()
+        else:
+            threading.Thread(
+                target=self._poll, name=f"poll-{self.name}", daemon=True
+            ).start()
+        self._thread = threading.Thread(
+            target=self._dispatch, name=f"watch-{self.name}", daemon=True
+        )
+        self._thread.start()
+        print(f"开始监听 {self.root}（{self.backend}）")
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            self._wakeup.notify_all()
+        if self._observer is not None:
+            self._observer.stop()
+
+    def notify(self, path: str):
+        """记录一个变化的路径（绝对路径或相对root的路径）"""
+        path = os.path.abspath(os.path.join(self.root, path))
+        if path == self.root or not path.startswith(self.root + os.sep):
+            return
+        rel_path = os.path.relpath(path, self.root).replace(os.sep, "/")
+        if _is_temp(rel_path):
+            return
+        with self._lock:
+            now = time.monotonic()
+            if not self._pending:
+                self._first_event = now
+            self._pending.add(rel_path)
+            self._last_event = now
+            self.events += 1
+            self._wakeup.notify_all()
+
+    def _poll(self):
+        previous = _snapshot(self.root)
+        while not self._stopped.wait(self._poll_interval):
+            current = _snapshot(self.root)
+            for rel_path in set(previous) | set(current):
+                if previous.get(rel_path) != current.get(rel_path):
+                    self.notify(rel_path)
+            previous = current
+
+    def _take_batch(self) -> Optional[List[str]]:
+        with self._lock:
+            while not self._stopped.is_set():
+                if not self._pending:
+                    self._wakeup.wait()
+                    continue
+                now = time.monotonic()
+                due = min(
+                    self._last_event + self._debounce,
+                    self._first_event + self._debounce * _MAX_DELAY_FACTOR,
+                )
+                if now >= due:
+                    batch = sorted(self._pending)
+                    self._pending.clear()
+                    return batch
+                self._wakeup.wait(due - now)
+            return None
+
+    def _dispatch(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            self.batches += 1
+            self.last_batch_at = time.time()
+            print(f"{self.name} 有 {len(batch)} 个路径发生变化")
+            try:
+                self._on_change(batch)
+            except Exception as e:
+                print(f"{self.name} 处理文件变化时出错: {e}")
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "pending": len(self._pending),
+                "events": self.events,
+                "batches": self.batches,
+                "last-batch-at": (
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.last_batch_at))
+                    if self.last_batch_at
+                    else None
+                ),
+            }
@@ -0,0 +1,86 @@
+'''检索结果多样化：用MMR从候选中选出彼此差异大的文本块，并去掉同一文件相邻文本块之间重叠的文字'''
+from typing import List
+
+import numpy as np
+from langchain_core.documents import Document
+
+# 重叠部分短于这个长度时不处理，避免误删偶然相同的短语
+_MIN_OVERLAP = 20
+# 只检查首尾这么长的范围，分块时的重叠长度（chunk-overlap）远小于它
+_MAX_OVERLAP = 512
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def cosine_relevance(query: List[float], vectors: np.ndarray) -> np.ndarray:
+    return _normalize(vectors) @ _normalize(np.asarray(query, dtype=np.float32))
+
+
+def mmr_select(relevance: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float = 0.5) -> List[int]:
+    """最大边际相关：每次选 lambda*相关度 - (1-lambda)*与已选结果的最大相似度 最高的候选
+
+    relevance为每个候选与问题的相关度，vectors为候选的向量，返回被选中候选的下标（按选中顺序）。
+    候选两两之间的相似度一次矩阵乘法算出，每选一个只需更新一列最大值。
+    """
+    n = len(relevance)
+    if n == 0 or k <= 0:
+        return []
+    vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+    similarity = vectors @ vectors.T
+    relevance = np.asarray(relevance, dtype=np.float32)
+
+    selected = [int(np.argmax(relevance))]
+    # 每个候选与已选结果的最大相似度
+    redundancy = similarity[selected[0]].copy()
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, n):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
+
+
+def _overlap_length(head: str, tail: str) -> int:
+    """head的结尾与tail的开头相同部分的长度"""
+    for length in range(min(len(head), len(tail), _MAX_OVERLAP), _MIN_OVERLAP - 1, -1):
+        if head.endswith(tail[:length]):
+            return length
+    return 0
+
+
+def remove_overlaps(docs: List[Document]) -> List[Document]:
+    """同一来源的文本块被另一个完全包含时丢弃，首尾重叠时从排名靠后的一块中裁掉重叠部分
+
+    返回新的Document，不修改向量库中的原文档。
+    """
+    kept: List[Document] = []
+    for doc in docs:
+        text = doc.page_content
+        source = doc.metadata.get("source")
+        for other in kept:
+            if other.metadata.get("source") != source:
+                continue
+            if text in other.page_content:
+                text = ""
+                break
+            length = _overlap_length(other.page_content, text)
+            if length:
+                text = text[length:]
+            length = _overlap_length(text, other.page_content)
+            if length:
+                text = text[:-length]
+        # 裁剪后只剩很短的片段也一并丢弃
+        if not text.strip() or (text != doc.page_content and len(text.strip()) < _MIN_OVERLAP):
+            continue
+        if text == doc.page_content:
+            kept.append(doc)
+        else:
+            kept.append(Document(page_content=text, metadata=dict(doc.metadata), id=doc.id))
+    return kept
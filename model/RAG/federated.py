@@ -0,0 +1,44 @@
+'''联合检索：把公共知识库和用户文件的检索结果按与问题的相似度合并，并在metadata中标注每个文本块的来源'''
+from typing import Dict, List
+
+from langchain_core.documents import Document
+
+# metadata中记录来源的字段及其取值
+ORIGIN_KEY = "origin"
+KNOWLEDGE_BASE = "knowledge-base"
+USER = "user"
+
+
+def merge_by_score(
+    results: Dict[str, List[Document]], k: int, quotas: Dict[str, int]
+) -> List[Document]:
+    """results为 来源 -> 该来源按相似度降序的文档，返回相似度最高的k个，按相似度降序
+
+    各向量库使用同一个编码模型，metadata["score"]都是与问题的余弦相似度，可以直接比较。
+    每个来源先最多取quotas中的数量，避免一个来源挤掉另一个；名额没有用完时再由其他来源的剩余结果补足。
+    """
+    candidates = sorted(
+        (
+            (doc.metadata.get("score", 0.0), rank, origin, doc)
+            for origin, docs in results.items()
+            for rank, doc in enumerate(docs)
+        ),
+        key=lambda item: (-item[0], item[1]),
+    )
+    taken: Dict[str, int] = {}
+    selected, rest = [], []
+    for item in candidates:
+        origin = item[2]
+        if len(selected) < k and taken.get(origin, 0) < quotas.get(origin, k):
+            taken[origin] = taken.get(origin, 0) + 1
+            selected.append(item)
+        else:
+            rest.append(item)
+    selected.extend(rest[: k - len(selected)])
+    selected.sort(key=lambda item: (-item[0], item[1]))
+
+    merged = []
+    for _, _, origin, doc in selected:
+        doc.metadata[ORIGIN_KEY] = origin
+        merged.append(doc)
+    return merged
@@ -0,0 +1,94 @@
+'''知识库文件清单：记录每个文件的大小、修改时间、内容哈希和对应的文本块id，用于增量构建索引'''
+import os
+import hashlib
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Tuple
+
+
+@dataclass
+class FileRecord:
+    path: str  # 相对知识库目录的路径，统一使用"/"分隔
+    size: int
+    mtime: float
+    content_hash: str
+    chunk_ids: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FileRecord":
+        return cls(**data)
+
+
+@dataclass
+class ManifestDiff:
+    added: List[str] = field(default_factory=list)
+    modified: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.modified or self.removed)
+
+
+def file_hash(path: str, block_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def chunk_id(rel_path: str, index: int) -> str:
+    """文本块id由文件路径和块序号决定，同一文件重建时id保持稳定"""
+    digest = hashlib.sha1(rel_path.encode("utf-8")).hexdigest()[:16]
+    return f"{digest}-{index}"
+
+
+def scan_files(data_path: str, extensions) -> List[str]:
+    """遍历一次目录，返回所有支持格式文件的相对路径"""
+    rel_paths = []
+    for root, _, files in os.walk(data_path):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in extensions:
+                full_path = os.path.join(root, name)
+                rel_paths.append(os.path.relpath(full_path, data_path).replace(os.sep, "/"))
+    rel_paths.sort()
+    return rel_paths
+
+
+def diff_files(
+    data_path: str, records: Dict[str, FileRecord], rel_paths: List[str]
+) -> Tuple[ManifestDiff, Dict[str, FileRecord]]:
+    """对比磁盘文件和清单，返回差异以及新的文件记录（新增和修改的文件尚未填写chunk_ids）
+
+    大小和修改时间都没变的文件直接视为未修改，不再计算哈希；
+    只是修改时间变了但内容哈希相同的文件也视为未修改。
+    """
+    diff = ManifestDiff()
+    new_records: Dict[str, FileRecord] = {}
+
+    for rel_path in rel_paths:
+        full_path = os.path.join(data_path, rel_path)
+        stat = os.stat(full_path)
+        old = records.get(rel_path)
+        if old is not None and old.size == stat.st_size and old.mtime == stat.st_mtime:
+            diff.unchanged.append(rel_path)
+            new_records[rel_path] = old
+            continue
+
+        content_hash = file_hash(full_path)
+        record = FileRecord(rel_path, stat.st_size, stat.st_mtime, content_hash)
+        if old is None:
+            diff.added.append(rel_path)
+        elif old.content_hash == content_hash:
+            record.chunk_ids = old.chunk_ids
+            diff.unchanged.append(rel_path)
+        else:
+            diff.modified.append(rel_path)
+        new_records[rel_path] = record
+
+    diff.removed = sorted(set(records) - set(new_records))
+    return diff, new_records
@@ -0,0 +1,451 @@
+'''带BM25关键词索引的FAISS向量库：增删文本块时同步维护关键词索引，并支持向量与关键词的混合检索
+
+使用父子分块时，向量库中存放的是子块，父块存放在parents中，子块的metadata["parent_id"]指向所属父块。
+文本块和父块都存放在CompactDocstore中，保存后以内存映射方式加载；
+以read_only方式加载时向量和关键词索引同样内存映射（hnsw除外，见index_factory），多个进程共享同一份页缓存，但不能再增删文本块。
+多个用户共用一个向量库时，文本块的metadata["owner"]为所属用户，检索时传入owner只在该用户的文本块中检索。
+开启近似重复合并时，重复的文本块不写入向量库，只在aliases中记为代表文本块的别名，检索结果的metadata["sources"]列出所有来源文件。
+'''
+import os
+import uuid
+import pickle
+import threading
+from typing import Any, ClassVar, Collection, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStoreRetriever
+from langchain_community.vectorstores.faiss import FAISS
+
+from model.RAG.compact_docstore import CompactDocstore
+from model.RAG.diversify import cosine_relevance, mmr_select, remove_overlaps
+from model.RAG.index_factory import read_index, write_index
+from model.RAG.lexical_index import OWNERS_FILE, LexicalIndex, reciprocal_rank_scores
+from model.RAG.near_dup import MinHashIndex
+
+
+_NO_OWNER = -1
+
+
+class HybridFAISS(FAISS):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lexical = LexicalIndex()
+        self.parents = CompactDocstore()
+        # generation区分不同的向量库对象，version在每次增删文本块后加一，检索缓存据此失效
+        self.generation = uuid.uuid4().hex
+        self.version = 0
+        self.read_only = False
+        self._positions_version = None
+        # 每个向量所属用户的编号（与faiss下标一一对应，-1表示不属于任何用户），以及每个用户的文本块版本号
+        self.owners = np.full(self.index.ntotal, _NO_OWNER, dtype=np.int32)
+        self._owner_codes: Dict[str, int] = {}
+        self._owner_versions: Dict[str, int] = {}
+        # 用户编号 -> 该用户的faiss下标；添加时追加，删除后下标整体前移，下次检索时重新分组
+        self._owner_positions: Optional[Dict[int, np.ndarray]] = None
+        # 多个用户共用的向量库会在检索的同时被其他用户的上传修改，增删和检索互斥
+        self._lock = threading.RLock()
+        # 近似重复合并：代表文本块的MinHash签名，以及 重复文本块id -> (代表文本块id, 来源文件)
+        self.minhash: Optional[MinHashIndex] = None
+        self.aliases: Dict[str, Tuple[str, str]] = {}
+        self._alias_ids: Dict[str, List[str]] = {}
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError("只读加载的向量库不能增删文本块")
+
+    def _owner_code(self, owner: Optional[str]) -> int:
+        if owner is None:
+            return _NO_OWNER
+        return self._owner_codes.setdefault(owner, len(self._owner_codes))
+
+    def _add_owners(self, metadatas: Optional[List[dict]], count: int) -> np.ndarray:
+        """记录新增向量所属的用户，返回用户编号，关键词索引用同样的编号"""
+        owners = [(metadata or {}).get("owner") for metadata in metadatas or [None] * count]
+        start = len(self.owners)
+        codes = np.array([self._owner_code(o) for o in owners], dtype=np.int32)
+        self.owners = np.concatenate([self.owners, codes])
+        for owner in set(owners) - {None}:
+            self._owner_versions[owner] = self._owner_versions.get(owner, 0) + 1
+            if self._owner_positions is not None:
+                code = self._owner_codes[owner]
+                added = start + np.flatnonzero(codes == code)
+                existing = self._owner_positions.get(code)
+                self._owner_positions[code] = (
+                    added if existing is None else np.concatenate([existing, added])
+                )
+        return codes
+
+    def _group_owners(self) -> Dict[int, np.ndarray]:
+        order = np.argsort(self.owners, kind="stable")
+        codes, starts = np.unique(self.owners[order], return_index=True)
+        return {
+            int(code): positions
+            for code, positions in zip(codes, np.split(order, starts[1:]))
+            if code != _NO_OWNER
+        }
+
+    def owner_positions(self, owner: str) -> np.ndarray:
+        """该用户所有文本块的faiss下标"""
+        code = self._owner_codes.get(owner)
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        if self._owner_positions is None:
+            self._owner_positions = self._group_owners()
+        return self._owner_positions.get(code, np.zeros(0, dtype=np.int64))
+
+    def scope_version(self, owner: Optional[str] = None) -> int:
+        """检索缓存用的版本号：指定owner时只随该用户的文本块变化，其他用户上传文件不会让它的缓存失效"""
+        if owner is None:
+            return self.version
+        return self._owner_versions.get(owner, 0)
+
+    def add_embeddings(
+        self,
+        text_embeddings: Iterable[Tuple[str, List[float]]],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        self._check_writable()
+        text_embeddings = list(text_embeddings)
+        with self._lock:
+            ids = super().add_embeddings(text_embeddings, metadatas, ids, **kwargs)
+            codes = self._add_owners(metadatas, len(ids))
+            self.lexical.add(ids, (text for text, _ in text_embeddings), codes.tolist())
+            self.version += 1
+        return ids
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        self._check_writable()
+        texts = list(texts)
+        with self._lock:
+            ids = super().add_texts(texts, metadatas, ids, **kwargs)
+            codes = self._add_owners(metadatas, len(ids))
+            self.lexical.add(ids, texts, codes.tolist())
+            self.version += 1
+        return ids
+
+    def add_parents(self, parents: Dict[str, Document]):
+        # 同一个父块会随它的每一批子块传入，只保存第一次
+        with self._lock:
+            self.parents.add({id: doc for id, doc in parents.items() if id not in self.parents})
+
+    def add_aliases(self, aliases: Dict[str, Tuple[str, str]]):
+        """记录重复的文本块：重复文本块id -> (代表文本块id, 来源文件)"""
+        with self._lock:
+            for alias_id, (canonical_id, source) in aliases.items():
+                self.aliases[alias_id] = (canonical_id, source)
+                self._alias_ids.setdefault(canonical_id, []).append(alias_id)
+
+    def aliases_of(self, ids: Iterable[str]) -> List[str]:
+        """以这些文本块为代表的重复文本块id"""
+        return [alias_id for id in ids for alias_id in self._alias_ids.get(id, ())]
+
+    def _remove_aliases(self, alias_ids: Iterable[str]):
+        for alias_id in alias_ids:
+            canonical_id, _ = self.aliases.pop(alias_id)
+            remaining = self._alias_ids.get(canonical_id)
+            if remaining is not None:
+                remaining.remove(alias_id)
+                if not remaining:
+                    del self._alias_ids[canonical_id]
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        self._check_writable()
+        with self._lock:
+            return self._delete(ids, **kwargs)
+
+    def _delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        # 重复文本块只是别名，不在faiss中；代表文本块被删除后它的别名也失效，由调用方重新编码别名所在的文件
+        alias_ids = [id for id in ids or [] if id in self.aliases]
+        ids = [id for id in ids or [] if id not in self.aliases]
+        self._remove_aliases(alias_ids)
+        self._remove_aliases(self.aliases_of(ids))
+        if not ids:
+            return True
+        if self.minhash is not None:
+            self.minhash.remove(ids)
+        # 同一个父块的子块都来自同一个文件，随文件一起删除，因此删除子块时直接删除其父块
+        for id in ids:
+            doc = self.docstore.search(id)
+            if isinstance(doc, Document) and "parent_id" in doc.metadata:
+                self.parents.delete([doc.metadata["parent_id"]])
+        deleted = set(ids)
+        positions = [i for i, id in self.index_to_docstore_id.items() if id in deleted]
+        result = super().delete(ids, **kwargs)
+        self.lexical.remove(ids)
+        # faiss删除向量后后面的下标依次前移，owners同样按原顺序删除
+        names = {code: owner for owner, code in self._owner_codes.items()}
+        for code in set(self.owners[positions].tolist()) - {_NO_OWNER}:
+            self._owner_versions[names[code]] = self._owner_versions.get(names[code], 0) + 1
+        self.owners = np.delete(self.owners, positions)
+        self._owner_positions = None
+        self.version += 1
+        return result
+
+    def save_local(self, folder_path: str, index_name: str = "index") -> None:
+        if not isinstance(self.docstore, CompactDocstore):
+            super().save_local(folder_path, index_name)
+        else:
+            os.makedirs(folder_path, exist_ok=True)
+            write_index(self.index, os.path.join(folder_path, f"{index_name}.faiss"))
+            self.docstore.save(os.path.join(folder_path, f"{index_name}.docstore"))
+            # docstore单独保存，pkl中只保留faiss下标到文本块id的映射
+            with open(os.path.join(folder_path, f"{index_name}.pkl"), "wb") as f:
+                pickle.dump((None, self.index_to_docstore_id), f)
+        self.lexical.save(os.path.join(folder_path, f"{index_name}.lexical"))
+        if self.parents:
+            self.parents.save(os.path.join(folder_path, f"{index_name}.parents"))
+        if self._owner_codes:
+            with open(os.path.join(folder_path, f"{index_name}.owners.pkl"), "wb") as f:
+                pickle.dump((self._owner_codes, self.owners), f)
+        if self.minhash is not None:
+            self.minhash.save(os.path.join(folder_path, f"{index_name}.minhash.pkl"))
+            with open(os.path.join(folder_path, f"{index_name}.aliases.pkl"), "wb") as f:
+                pickle.dump(self.aliases, f)
+
+    @classmethod
+    def load_local(
+        cls,
+        folder_path: str,
+        embeddings: Embeddings,
+        index_name: str = "index",
+        *,
+        allow_dangerous_deserialization: bool = False,
+        read_only: bool = False,
+        **kwargs: Any,
+    ) -> "HybridFAISS":
+        if not allow_dangerous_deserialization:
+            raise ValueError(
+                "加载索引需要反序列化pickle文件，确认索引文件可信后传入 allow_dangerous_deserialization=True"
+            )
+        index = read_index(os.path.join(folder_path, f"{index_name}.faiss"), read_only)
+        with open(os.path.join(folder_path, f"{index_name}.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        vectorstore = cls(embeddings, index, docstore, index_to_docstore_id, **kwargs)
+        vectorstore.read_only = read_only
+        docstore_path = os.path.join(folder_path, f"{index_name}.docstore")
+        if os.path.exists(docstore_path):
+            vectorstore.docstore = CompactDocstore.load(docstore_path)
+        owners_path = os.path.join(folder_path, f"{index_name}.owners.pkl")
+        if os.path.exists(owners_path):
+            with open(owners_path, "rb") as f:
+                vectorstore._owner_codes, vectorstore.owners = pickle.load(f)
+            vectorstore._owner_positions = None
+        lexical_path = os.path.join(folder_path, f"{index_name}.lexical")
+        if os.path.exists(os.path.join(lexical_path, OWNERS_FILE)) or (
+            os.path.exists(lexical_path) and not vectorstore._owner_codes
+        ):
+            vectorstore.lexical = LexicalIndex.load(lexical_path)
+        else:
+            # 旧版本保存的索引没有关键词索引、以pickle保存或没有记录文本块所属的用户，从docstore中的文本重建
+            ids = [vectorstore.index_to_docstore_id[i] for i in range(len(vectorstore.index_to_docstore_id))]
+            vectorstore.lexical.add(
+                ids,
+                (vectorstore.docstore.search(id).page_content for id in ids),
+                vectorstore.owners.tolist(),
+            )
+        parents_path = os.path.join(folder_path, f"{index_name}.parents")
+        if os.path.exists(parents_path):
+            vectorstore.parents = CompactDocstore.load(parents_path)
+        minhash_path = os.path.join(folder_path, f"{index_name}.minhash.pkl")
+        if os.path.exists(minhash_path):
+            vectorstore.minhash = MinHashIndex.load(minhash_path)
+            with open(os.path.join(folder_path, f"{index_name}.aliases.pkl"), "rb") as f:
+                vectorstore.add_aliases(pickle.load(f))
+        return vectorstore
+
+    def _search(
+        self, embedding: List[float], k: int, positions: Optional[np.ndarray] = None
+    ) -> List[Tuple[str, float]]:
+        if positions is not None:
+            return self._search_positions(embedding, k, positions)
+        if self.index.ntotal == 0:
+            return []
+        vector = np.array([embedding], dtype=np.float32)
+        scores, indices = self.index.search(vector, min(k, self.index.ntotal))
+        return [
+            (self.index_to_docstore_id[i], float(score))
+            for i, score in zip(indices[0], scores[0])
+            if i != -1
+        ]
+
+    def _search_positions(
+        self, embedding: List[float], k: int, positions: np.ndarray
+    ) -> List[Tuple[str, float]]:
+        # 单个用户的文本块很少，取出它们的向量精确计算距离，耗时只与该用户的文本块数有关
+        if len(positions) == 0:
+            return []
+        vectors = self.index.reconstruct_batch(positions)
+        distances = ((vectors - np.asarray(embedding, dtype=np.float32)) ** 2).sum(axis=1)
+        order = np.argsort(distances)[:k]
+        return [(self.index_to_docstore_id[int(positions[i])], float(distances[i])) for i in order]
+
+    def get_documents(
+        self, results: List[Tuple[str, float]], dedup_overlap: bool = False, **kwargs: Any
+    ) -> List[Document]:
+        """按 (文本块id, 相似度) 取出文档，相似度写入metadata["score"]；dedup_overlap为True时去掉同一文件的文本块之间重叠的部分
+
+        子块会被替换为它所属的父块。
+        """
+        docs = []
+        for id, score in results:
+            doc = self.docstore.search(id)
+            if not isinstance(doc, Document):
+                # 检索后文本块已被删除
+                continue
+            metadata = {"score": round(score, 4)}
+            alias_ids = self._alias_ids.get(id)
+            if alias_ids:
+                sources = [doc.metadata.get("source")] + [self.aliases[i][1] for i in alias_ids]
+                metadata["sources"] = list(dict.fromkeys(sources))
+            doc = self.parents.get(doc.metadata.get("parent_id"), doc)
+            # 复制一份再写入相似度，不修改docstore中的文档
+            docs.append(
+                Document(
+                    page_content=doc.page_content,
+                    metadata={**doc.metadata, **metadata},
+                    id=doc.id,
+                )
+            )
+        return remove_overlaps(docs) if dedup_overlap else docs
+
+    def get_vectors(self, ids: List[str], positions: Optional[np.ndarray] = None) -> np.ndarray:
+        """取出文本块的向量；索引不支持还原向量时（如未建直接映射的ivf）用编码模型重新编码，通常命中向量缓存
+
+        ids都在positions（如某个用户的faiss下标）中时传入positions，只为这些下标建立反查表，
+        不必在其他用户增删文本块后为整个向量库重建。
+        """
+        if positions is not None:
+            lookup = {self.index_to_docstore_id[i]: i for i in positions.tolist()}
+        else:
+            if self._positions_version != (self.generation, self.version):
+                self._positions = {id: i for i, id in self.index_to_docstore_id.items()}
+                self._positions_version = (self.generation, self.version)
+            lookup = self._positions
+        try:
+            return np.stack([self.index.reconstruct(lookup[id]) for id in ids])
+        except RuntimeError:
+            texts = [self.docstore.search(id).page_content for id in ids]
+            return np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+
+    def retrieve_ids(self, *args: Any, **kwargs: Any) -> List[Tuple[str, float]]:
+        with self._lock:
+            return self._retrieve_ids(*args, **kwargs)
+
+    def _retrieve_ids(
+        self,
+        query: str,
+        embedding: List[float],
+        search_type: str = "similarity",
+        k: int = 4,
+        fetch_k: int = 20,
+        rrf_k: int = 60,
+        lambda_mult: Optional[float] = None,
+        score_threshold: Optional[float] = None,
+        min_k: int = 1,
+        owner: Optional[str] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[str, float]]:
+        """用已经编码好的查询向量检索，返回 (文本块id, 与问题的余弦相似度)
+
+        hybrid时向量检索和BM25检索各取fetch_k个候选，按倒数排名融合后返回前k个。
+        lambda_mult不为None时先取fetch_k个候选，再用MMR选出彼此差异大的k个。
+        使用父子分块时先取fetch_k个子块，每个父块只保留排名最高的子块，返回的是k个不同父块的子块。
+        score_threshold不为None时只保留相似度不低于阈值的结果，至少一个达到阈值时按排名补足min_k个，
+        一个都没有达到时返回空列表。
+        owner不为None时向量和关键词检索都只在该用户的文本块中进行，耗时只与该用户的文本块数有关。
+        """
+        # 查询向量只转换一次，向量检索、过滤检索和相似度计算都直接使用
+        embedding = np.asarray(embedding, dtype=np.float32)
+        candidates = k if lambda_mult is None and not self.parents else max(k, fetch_k)
+        rank_scores = None
+        positions = None if owner is None else self.owner_positions(owner)
+        if search_type == "similarity":
+            ids = [id for id, _ in self._search(embedding, candidates, positions)]
+        elif search_type == "hybrid":
+            dense_ids = [id for id, _ in self._search(embedding, fetch_k, positions)]
+            if owner is None:
+                lexical = self.lexical.search(query, fetch_k)
+            elif owner in self._owner_codes:
+                lexical = self.lexical.search(query, fetch_k, self._owner_codes[owner])
+            else:
+                lexical = []
+            lexical_ids = [id for id, _ in lexical]
+            fused = reciprocal_rank_scores([dense_ids, lexical_ids], rrf_k)[:candidates]
+            ids = [id for id, _ in fused]
+            rank_scores = np.array([score for _, score in fused], dtype=np.float32)
+        else:
+            raise ValueError(f"search_type of {search_type} not supported by retrieve_ids.")
+        if self.parents:
+            keep = self._best_child_per_parent(ids)
+            ids = [ids[i] for i in keep]
+            if rank_scores is not None:
+                rank_scores = rank_scores[keep]
+        if not ids:
+            return []
+
+        # L2距离随向量长度变化，统一换算成余弦相似度，便于设置阈值
+        vectors = self.get_vectors(ids, positions)
+        similarity = cosine_relevance(embedding, vectors)
+        if lambda_mult is not None and len(ids) > k:
+            # 混合检索的融合得分同时反映了向量和关键词的相关度，缩放到0~1后作为MMR的相关度
+            relevance = similarity if rank_scores is None else rank_scores / rank_scores.max()
+            order = mmr_select(relevance, vectors, k, lambda_mult)
+        else:
+            order = range(min(k, len(ids)))
+        results = [(ids[i], float(similarity[i])) for i in order]
+
+        if score_threshold is None:
+            return results
+        if all(score < score_threshold for _, score in results):
+            return []
+        return [
+            (id, score)
+            for rank, (id, score) in enumerate(results)
+            if score >= score_threshold or rank < min_k
+        ]
+
+    def _best_child_per_parent(self, ids: List[str]) -> List[int]:
+        """ids按排名从高到低，返回每个父块第一次出现的位置"""
+        seen = set()
+        keep = []
+        for i, id in enumerate(ids):
+            parent_id = self.docstore.search(id).metadata.get("parent_id", id)
+            if parent_id not in seen:
+                seen.add(parent_id)
+                keep.append(i)
+        return keep
+
+    def search_documents(self, query: str, search_type: str, **kwargs: Any) -> List[Document]:
+        results = self.retrieve_ids(query, self._embed_query(query), search_type, **kwargs)
+        return self.get_documents(results, **kwargs)
+
+    def as_retriever(self, **kwargs: Any) -> "HybridRetriever":
+        tags = kwargs.pop("tags", None) or [*self._get_retriever_tags()]
+        return HybridRetriever(vectorstore=self, tags=tags, **kwargs)
+
+
+class HybridRetriever(VectorStoreRetriever):
+    """在VectorStoreRetriever的基础上增加 search_type="hybrid"，similarity和hybrid都支持MMR多样化和重叠去重"""
+
+    allowed_search_types: ClassVar[Collection[str]] = (
+        "similarity",
+        "similarity_score_threshold",
+        "mmr",
+        "hybrid",
+    )
+
+    def _get_relevant_documents(self, query: str, *, run_manager, **kwargs: Any) -> List[Document]:
+        if self.search_type in ("similarity", "hybrid"):
+            return self.vectorstore.search_documents(query, self.search_type, **(self.search_kwargs | kwargs))
+        return super()._get_relevant_documents(query, run_manager=run_manager, **kwargs)
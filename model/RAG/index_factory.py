@@ -0,0 +1,241 @@
+'''FAISS索引类型的选择与创建
+
+不同索引类型在内存、速度和召回率之间的取舍（以768维向量为例）：
+    flat        精确检索，每个向量3KB，召回率100%，查询耗时随文本块数线性增长，适合十万级以下
+    flat-fp16   向量以半精度存储，内存减半，召回率几乎不变，查询耗时与flat相当
+    ivf         倒排索引，先找nprobe个最近的聚类中心再在其中精确检索；nprobe/nlist越大召回越高、越慢，
+                nprobe取nlist的1%~5%时召回率通常在95%以上，适合百万级
+    ivf-pq      倒排索引+乘积量化，每个向量仅占pq-m字节（如64字节，压缩约48倍），召回率约85%~95%，
+                适合内存放不下原始向量的千万级知识库
+    hnsw        图索引，毫秒级查询且召回率高（ef-search越大召回越高），内存比flat多约hnsw-m*8字节/向量
+需要训练的索引（ivf、ivf-pq）在文本块太少时会退回flat，知识库增长到足够大时自动重建。
+ivf、ivf-pq、hnsw删除或修改文件时会整体重建（向量来自缓存，只需重新解析和加入索引），适合很少修改的知识库。
+
+只读加载时多个进程共享同一份页缓存的方式：flat、flat-fp16的向量单独保存为npy文件，以内存映射方式打开后用MappedFlatIndex检索；
+ivf、ivf-pq的倒排表由faiss内存映射；hnsw只有在faiss支持IO_FLAG_MMAP_IFC时才能映射，否则每个进程各自读入一份。
+'''
+import os
+from typing import Optional
+
+import faiss
+import numpy as np
+
+from config.config import Config
+
+INDEX_TYPES = ("flat", "flat-fp16", "ivf", "ivf-pq", "hnsw")
+
+# kmeans每个聚类中心至少需要的训练向量数
+_POINTS_PER_CENTROID = 39
+# ivf至少训练出这么多个聚类中心才有意义，否则直接使用flat
+_MIN_NLIST = 8
+# 乘积量化每个子空间有256个码字
+_PQ_CENTROIDS = 256
+# 内存映射的flat索引每次取出这么多个向量计算距离，fp16的向量按块转换成float32
+_SEARCH_BLOCK = 1 << 16
+
+
+class IndexSpec(object):
+    """根据配置创建FAISS索引，并负责训练、检索参数设置和是否需要重建的判断"""
+
+    def __init__(
+        self,
+        index_type: str = "flat",
+        nlist: int = 1024,
+        nprobe: int = 16,
+        pq_m: int = 64,
+        hnsw_m: int = 32,
+        ef_search: int = 64,
+    ):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"不支持的索引类型 {index_type}，可选 {INDEX_TYPES}")
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+
+    @classmethod
+    def from_config(cls) -> "IndexSpec":
+        conf = Config.get_instance().get_with_nested_params("model", "embedding", "index")
+        return cls(
+            index_type=conf.get("type", "flat"),
+            nlist=conf.get("nlist", 1024),
+            nprobe=conf.get("nprobe", 16),
+            pq_m=conf.get("pq-m", 64),
+            hnsw_m=conf.get("hnsw-m", 32),
+            ef_search=conf.get("ef-search", 64),
+        )
+
+    def manifest(self) -> dict:
+        """影响索引结构的参数，变化时需要重建；nprobe、ef-search只影响检索，加载后重新设置即可"""
+        manifest = {"index-type": self.index_type}
+        if self.index_type in ("ivf", "ivf-pq"):
+            manifest["index-nlist"] = self.nlist
+        if self.index_type == "ivf-pq":
+            manifest["index-pq-m"] = self.pq_m
+        if self.index_type == "hnsw":
+            manifest["index-hnsw-m"] = self.hnsw_m
+        return manifest
+
+    @property
+    def needs_training(self) -> bool:
+        return self.index_type in ("ivf", "ivf-pq")
+
+    @property
+    def train_size(self) -> int:
+        """训练所需的向量数，流水线会先缓存这么多向量再创建索引"""
+        if not self.needs_training:
+            return 0
+        return self.nlist * _POINTS_PER_CENTROID
+
+    def _min_train_size(self) -> int:
+        if self.index_type == "ivf-pq":
+            return _PQ_CENTROIDS * _POINTS_PER_CENTROID
+        return _MIN_NLIST * _POINTS_PER_CENTROID
+
+    def create(self, train_vectors: np.ndarray) -> faiss.Index:
+        """创建（必要时训练）一个空索引，向量由调用方随后加入"""
+        dim = train_vectors.shape[1]
+        if self.index_type == "flat-fp16":
+            return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16)
+        if self.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, self.hnsw_m)
+            self.configure(index)
+            return index
+        if not self.needs_training or len(train_vectors) < self._min_train_size():
+            return faiss.IndexFlatL2(dim)
+
+        nlist = min(self.nlist, len(train_vectors) // _POINTS_PER_CENTROID)
+        if self.index_type == "ivf":
+            index = faiss.index_factory(dim, f"IVF{nlist},Flat")
+        else:
+            index = faiss.index_factory(dim, f"IVF{nlist},PQ{self.pq_m}")
+        index.train(np.ascontiguousarray(train_vectors, dtype=np.float32))
+        self.configure(index)
+        return index
+
+    def configure(self, index: faiss.Index):
+        """设置只影响检索的参数"""
+        if isinstance(index, MappedFlatIndex):
+            return
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.nprobe = min(self.nprobe, ivf.nlist)
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = self.ef_search
+
+    def should_rebuild(self, index: faiss.Index) -> bool:
+        """知识库小时退回的flat或聚类数不足的ivf，在向量足够多时值得用完整的聚类数重建"""
+        if not self.needs_training:
+            return False
+        ivf = faiss.try_extract_index_ivf(index)
+        current_nlist = ivf.nlist if ivf is not None else 0
+        if current_nlist >= self.nlist:
+            return False
+        if ivf is None:
+            return index.ntotal >= self._min_train_size()
+        # 向量数增长到可以训练出当前4倍以上的聚类中心时才重建，避免频繁重建
+        return index.ntotal >= 4 * current_nlist * _POINTS_PER_CENTROID
+
+
+def supports_removal(index: Optional[faiss.Index]) -> bool:
+    """删除向量后其余向量的下标是否依次前移，与LangChain重新编号的index_to_docstore_id保持一致
+
+    flat和flat-fp16删除后会压缩存储；ivf删除后其余向量仍保留原来的编号，与docstore对应不上；hnsw不支持删除；只读加载的索引不能修改。
+    """
+    if index is None or isinstance(index, (faiss.IndexHNSW, MappedFlatIndex)):
+        return False
+    return faiss.try_extract_index_ivf(index) is None
+
+
+class MappedFlatIndex(object):
+    """只读的flat、flat-fp16索引，向量以内存映射方式打开，同一台机器上的多个进程共享同一份页缓存
+
+    faiss 1.9加载IndexFlat时总会把向量复制到进程自己的内存中（IO_FLAG_MMAP只对ivf的倒排表有效），
+    这里只实现检索用到的接口，按块调用faiss.knn做精确检索，结果与IndexFlat相同。
+    """
+
+    def __init__(self, vectors: np.ndarray, metric_type: int = faiss.METRIC_L2):
+        self.vectors = vectors
+        self.ntotal, self.d = vectors.shape
+        self.metric_type = metric_type
+        self.is_trained = True
+
+    def search(self, x: np.ndarray, k: int):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        largest = self.metric_type == faiss.METRIC_INNER_PRODUCT
+        distances = [np.zeros((len(x), 0), dtype=np.float32)]
+        labels = [np.zeros((len(x), 0), dtype=np.int64)]
+        for start in range(0, self.ntotal, _SEARCH_BLOCK):
+            block = np.ascontiguousarray(self.vectors[start : start + _SEARCH_BLOCK], dtype=np.float32)
+            block_distances, block_labels = faiss.knn(x, block, min(k, len(block)), metric=self.metric_type)
+            distances.append(block_distances)
+            labels.append(block_labels + start)
+        distances = np.concatenate(distances, axis=1)
+        labels = np.concatenate(labels, axis=1)
+        order = np.argsort(-distances if largest else distances, axis=1, kind="stable")[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        labels = np.take_along_axis(labels, order, axis=1)
+        missing = k - labels.shape[1]
+        if missing > 0:
+            # 与faiss相同，不足k个时下标补-1
+            fill = -np.finfo(np.float32).max if largest else np.finfo(np.float32).max
+            distances = np.hstack([distances, np.full((len(x), missing), fill, dtype=np.float32)])
+            labels = np.hstack([labels, np.full((len(x), missing), -1, dtype=np.int64)])
+        return distances, labels
+
+    def reconstruct(self, key: int) -> np.ndarray:
+        return np.asarray(self.vectors[key], dtype=np.float32)
+
+    def reconstruct_batch(self, keys) -> np.ndarray:
+        return np.asarray(self.vectors[np.asarray(keys, dtype=np.int64)], dtype=np.float32)
+
+
+def _vectors_path(index_file: str) -> str:
+    return os.path.splitext(index_file)[0] + ".vectors.npy"
+
+
+def _flat_vectors(index: faiss.Index) -> Optional[np.ndarray]:
+    """flat、flat-fp16索引中向量的numpy视图（不复制），其他索引返回None"""
+    if isinstance(index, faiss.IndexFlat):
+        dtype = np.float32
+    elif isinstance(index, faiss.IndexScalarQuantizer) and index.sq.qtype == faiss.ScalarQuantizer.QT_fp16:
+        dtype = np.float16
+    else:
+        return None
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=dtype)
+    codes = faiss.rev_swig_ptr(index.codes.data(), index.codes.size())
+    return codes.view(dtype).reshape(index.ntotal, index.d)
+
+
+def write_index(index: faiss.Index, index_file: str):
+    """保存索引；flat、flat-fp16的向量单独写入npy文件，索引文件中只保存类型和参数"""
+    vectors = _flat_vectors(index)
+    if vectors is None:
+        faiss.write_index(index, index_file)
+        return
+    if isinstance(index, faiss.IndexFlat):
+        header = faiss.IndexFlat(index.d, index.metric_type)
+    else:
+        header = faiss.IndexScalarQuantizer(index.d, faiss.ScalarQuantizer.QT_fp16, index.metric_type)
+    faiss.write_index(header, index_file)
+    np.save(_vectors_path(index_file), vectors)
+
+
+def read_index(index_file: str, read_only: bool = False):
+    """加载write_index保存的索引；read_only为True时尽量以内存映射方式打开，加载后不能再增删向量"""
+    vectors_file = _vectors_path(index_file)
+    if not os.path.exists(vectors_file):
+        flags = 0
+        if read_only:
+            flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        return faiss.read_index(index_file, flags)
+    index = faiss.read_index(index_file)
+    vectors = np.load(vectors_file, mmap_mode="r")
+    if read_only:
+        return MappedFlatIndex(vectors, index.metric_type)
+    faiss.copy_array_to_vector(np.ascontiguousarray(vectors).view(np.uint8).ravel(), index.codes)
+    index.ntotal = len(vectors)
+    return index
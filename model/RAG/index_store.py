@@ -0,0 +1,219 @@
+'''知识库向量索引的磁盘持久化：保存/加载FAISS索引（向量+docstore）以及描述索引的清单(manifest)
+
+每次保存写入一个新的版本目录（如 knowledge-base.v1700000000000000000），index_path是指向当前版本的符号链接，
+写完后用rename原子地替换链接。读取方先解析链接再加载，不会读到写了一半的索引；
+不支持符号链接的系统（如未开启开发者模式的Windows）退回为先移走旧目录再重命名新目录。
+'''
+import os
+import json
+import time
+import shutil
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from model.RAG.chunker import ChunkSpec
+from model.RAG.file_manifest import FileRecord
+from model.RAG.index_factory import IndexSpec
+from model.RAG.hybrid_store import HybridFAISS
+from model.RAG.structured import StructuredSpec
+
+# 索引文件格式版本，保存格式发生不兼容变化时加一，旧索引会被自动重建
+INDEX_FORMAT_VERSION = 3
+MANIFEST_FILE = "manifest.json"
+# 每个源文件的大小、修改时间、内容哈希及其文本块id，用于增量构建
+FILES_FILE = "files.json"
+
+# 清单中仅用于记录、不参与匹配判断的字段
+_INFO_KEYS = ("created-at", "chunk-count")
+
+
+def build_manifest(
+    embedding_model: str,
+    embedding_model_version: str,
+    chunk_spec: ChunkSpec,
+    index_spec: IndexSpec,
+    structured_spec: Optional[StructuredSpec] = None,
+    dedup_threshold: float = 0,
+) -> dict:
+    """根据当前配置生成索引清单，清单不一致说明磁盘上的索引已过期"""
+    manifest = {
+        "format-version": INDEX_FORMAT_VERSION,
+        "embedding-model": embedding_model,
+        "embedding-model-version": embedding_model_version,
+    }
+    manifest.update(chunk_spec.manifest())
+    manifest.update(index_spec.manifest())
+    if structured_spec is not None:
+        manifest.update(structured_spec.manifest())
+    manifest["dedup-threshold"] = dedup_threshold
+    return manifest
+
+
+def read_manifest(index_path: str) -> Optional[dict]:
+    manifest_file = os.path.join(index_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return None
+    try:
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"读取索引清单 {manifest_file} 失败: {e}")
+        return None
+
+
+def manifest_matches(saved: Optional[dict], expected: dict) -> bool:
+    """两边的字段都参与比较，某个配置项从清单中消失（如关闭某项功能）同样视为不一致"""
+    if saved is None:
+        return False
+    for key in (set(saved) | set(expected)) - set(_INFO_KEYS):
+        if saved.get(key) != expected.get(key):
+            return False
+    return True
+
+
+def read_file_records(index_path: str) -> Dict[str, FileRecord]:
+    files_file = os.path.join(index_path, FILES_FILE)
+    if not os.path.exists(files_file):
+        return {}
+    try:
+        with open(files_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"读取文件清单 {files_file} 失败: {e}")
+        return {}
+    return {path: FileRecord.from_dict(record) for path, record in data.items()}
+
+
+def _version_paths(index_path: str) -> List[str]:
+    parent, name = os.path.split(os.path.abspath(index_path))
+    if not os.path.isdir(parent):
+        return []
+    prefix = f"{name}.v"
+    return sorted(
+        os.path.join(parent, entry)
+        for entry in os.listdir(parent)
+        if entry.startswith(prefix) and entry[len(prefix):].isdigit()
+    )
+
+
+def index_version(index_path: str) -> Optional[str]:
+    """当前索引版本的标识，保存了新版本后会变化；没有索引时返回None"""
+    if os.path.islink(index_path):
+        return os.path.realpath(index_path)
+    manifest_file = os.path.join(index_path, MANIFEST_FILE)
+    if os.path.exists(manifest_file):
+        return str(os.stat(manifest_file).st_mtime_ns)
+    return None
+
+
+def _swap_link(index_path: str, version_path: str) -> bool:
+    """把index_path原子地指向新版本目录，不支持符号链接时返回False"""
+    link_tmp = f"{index_path}.link.tmp"
+    try:
+        if os.path.lexists(link_tmp):
+            os.remove(link_tmp)
+        os.symlink(os.path.basename(version_path), link_tmp, target_is_directory=True)
+    except (OSError, NotImplementedError):
+        return False
+    if os.path.isdir(index_path) and not os.path.islink(index_path):
+        # 旧版本保存的是普通目录，先移走，只在第一次切换时发生
+        old_path = f"{index_path}.old"
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        os.rename(index_path, old_path)
+        os.replace(link_tmp, index_path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(link_tmp, index_path)
+    return True
+
+
+def _swap_dir(index_path: str, version_path: str):
+    old_path = f"{index_path}.old"
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(index_path):
+        os.rename(index_path, old_path)
+    os.rename(version_path, index_path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def remove_index(index_path: str):
+    """删除索引链接及其所有版本目录"""
+    if os.path.islink(index_path):
+        os.remove(index_path)
+    elif os.path.exists(index_path):
+        shutil.rmtree(index_path)
+    for path in _version_paths(index_path):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def save_index(
+    vectorstore: HybridFAISS,
+    index_path: str,
+    manifest: dict,
+    file_records: Optional[Dict[str, FileRecord]] = None,
+):
+    """写入新的版本目录后原子地切换，避免进程中断或其他进程读取时看到不完整的索引"""
+    current = os.path.realpath(index_path) if os.path.islink(index_path) else None
+    tmp_path = f"{index_path}.v{time.time_ns()}"
+    vectorstore.save_local(tmp_path)
+    manifest = dict(manifest)
+    manifest["created-at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    manifest["chunk-count"] = vectorstore.index.ntotal
+    with open(os.path.join(tmp_path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    if file_records is not None:
+        with open(os.path.join(tmp_path, FILES_FILE), "w", encoding="utf-8") as f:
+            json.dump(
+                {path: record.to_dict() for path, record in file_records.items()},
+                f,
+                ensure_ascii=False,
+            )
+
+    if _swap_link(index_path, tmp_path):
+        # 保留刚被替换的上一个版本，刚解析到它的只读进程仍可以完成加载；
+        # 已经内存映射了更早版本的进程不受删除影响，文件在它们重新加载后才真正释放
+        keep = {os.path.realpath(tmp_path), current}
+        for path in _version_paths(index_path):
+            if os.path.realpath(path) not in keep:
+                shutil.rmtree(path, ignore_errors=True)
+    else:
+        _swap_dir(index_path, tmp_path)
+    print(f"向量索引已保存到 {index_path}")
+
+
+def load_index(
+    index_path: str,
+    embedding: Embeddings,
+    expected_manifest: dict,
+    index_spec: Optional[IndexSpec] = None,
+    read_only: bool = False,
+) -> Optional[HybridFAISS]:
+    """清单与当前配置一致时加载磁盘索引，否则返回None由调用方重建
+
+    read_only为True时以内存映射方式只读加载，同一台机器上的多个进程共享一份页缓存（hnsw除外，见index_factory）。
+    """
+    # 先解析出当前版本目录，加载过程中即使切换了新版本也不会混读两个版本的文件
+    index_path = os.path.realpath(index_path)
+    saved = read_manifest(index_path)
+    if not manifest_matches(saved, expected_manifest):
+        if saved is not None:
+            print(f"索引 {index_path} 的清单与当前配置不一致，需要重建")
+        return None
+
+    try:
+        # docstore以pickle保存，这里的索引文件均由本程序自己生成
+        vectorstore = HybridFAISS.load_local(
+            index_path, embedding, allow_dangerous_deserialization=True, read_only=read_only
+        )
+    except Exception as e:
+        print(f"加载索引 {index_path} 失败: {e}")
+        return None
+    if index_spec is not None:
+        index_spec.configure(vectorstore.index)
+
+    print(f"已从 {index_path} 加载向量索引，共 {vectorstore.index.ntotal} 个文本块")
+    return vectorstore
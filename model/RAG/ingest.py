@@ -0,0 +1,155 @@
+'''文档解析引擎：一次遍历目录，按扩展名把文件分发给对应的加载器，在进程池中并行解析'''
+import os
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple, Union
+
+from langchain_core.documents import Document
+from langchain_community.document_loaders import (
+    MHTMLLoader,
+    TextLoader,
+    CSVLoader,
+)
+from langchain_community.document_loaders import (
+    UnstructuredWordDocumentLoader,
+    UnstructuredHTMLLoader,
+    UnstructuredMarkdownLoader,
+)
+
+from model.RAG.pdf_extract import PdfTextLoader
+from model.RAG.structured import INSTANCE as STRUCTURED, RecordStream, StructuredLoader
+
+
+# 各文件格式对应的加载器及其参数
+FILE_LOADERS = {
+    # 与对话中上传的PDF共用提取结果缓存，重复的文件不再解析
+    ".pdf": (PdfTextLoader, {}),
+    ".docx": (UnstructuredWordDocumentLoader, {}),
+    ".txt": (TextLoader, {"autodetect_encoding": True}),
+    # 配置了字段映射的CSV和所有JSONL按行流式解析（见Structured-data），其余CSV每行一个文档
+    ".csv": (CSVLoader, {"autodetect_encoding": True}),
+    ".jsonl": (StructuredLoader, {}),
+    ".html": (UnstructuredHTMLLoader, {}),
+    ".mhtml": (MHTMLLoader, {}),
+    ".md": (UnstructuredMarkdownLoader, {}),
+    # 要利用json数据要设置jq语句和content_key提取特定字段，这在不同json数据结构中有所不同，较为繁琐。
+    # 官方文档：https://api.python.langchain.com/en/latest/document_loaders/langchain_community.document_loaders.json_loader.JSONLoader.html
+    # ".json": (JSONLoader, {"jq_schema": ".", "text_content": False}),
+}
+
+
+def load_file(file_path: str) -> List[Document]:
+    """按扩展名选择加载器加载单个文件，加载失败时返回空列表"""
+    ext = os.path.splitext(file_path)[1].lower()
+    loader_cls, loader_kwargs = FILE_LOADERS[ext]
+    try:
+        return loader_cls(file_path, **loader_kwargs).load()
+    except Exception as e:
+        print(f"加载文件 {file_path} 失败: {e}")
+        return []
+
+
+def _timed_load(file_path: str) -> Tuple[List[Document], float]:
+    # 在子进程中执行，返回解析结果和耗时
+    start = time.perf_counter()
+    docs = load_file(file_path)
+    return docs, time.perf_counter() - start
+
+
+class IngestStats(object):
+    """按文件格式统计解析的文件数、字节数和耗时"""
+
+    def __init__(self):
+        self._stats: Dict[str, List[float]] = {}
+
+    def add(self, ext: str, size: int, seconds: float, doc_count: int):
+        stat = self._stats.setdefault(ext, [0, 0, 0.0, 0])
+        stat[0] += 1
+        stat[1] += size
+        stat[2] += seconds
+        stat[3] += doc_count
+
+    def report(self, wall_seconds: float):
+        if not self._stats:
+            return
+        print(f"文档解析完成，总耗时 {wall_seconds:.2f}s，各格式解析吞吐：")
+        for ext, (files, size, seconds, docs) in sorted(self._stats.items()):
+            seconds = max(seconds, 1e-6)
+            print(
+                f"  {ext:<6} 文件 {files:>5}  文档 {docs:>6}  "
+                f"{size / 1024 / 1024:8.2f}MB  解析 {seconds:7.2f}s  "
+                f"{files / seconds:7.2f} 文件/s  {size / 1024 / 1024 / seconds:6.2f} MB/s"
+            )
+
+
+def process_context():
+    """创建解析进程池使用的上下文
+
+    主进程中已经运行着Gradio、后台构建和模型预热等线程，直接fork可能复制到被其他线程持有的锁而死锁；
+    forkserver从一个单线程的服务进程fork子进程，不支持时（Windows）使用spawn。
+    两种方式都会在子进程中导入启动脚本，启动脚本中的服务只在 __main__ 下启动。
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _make_executor(max_workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=process_context())
+
+
+def ingest_files(
+    data_path: str, rel_paths: List[str], max_workers: int = 0
+) -> Iterator[Tuple[str, Union[List[Document], RecordStream]]]:
+    """并行解析文件，按rel_paths的顺序逐个产出 (相对路径, 文档列表)
+
+    max_workers为0时使用全部CPU核心，为1时在当前进程中顺序解析。
+    同时在途的文件数不超过进程数的两倍，下游处理慢时不会堆积整个语料的解析结果。
+    结构化数据文件产出的是RecordStream，由下游边读边编码，不在进程池中解析。
+    """
+    if not rel_paths:
+        return
+    max_workers = max_workers or os.cpu_count() or 1
+    max_workers = min(max_workers, len(rel_paths))
+
+    stats = IngestStats()
+    start = time.perf_counter()
+    executor = _make_executor(max_workers) if max_workers > 1 else None
+    pending = deque()
+    paths = iter(rel_paths)
+
+    def submit_next():
+        rel_path = next(paths, None)
+        if rel_path is None:
+            return
+        full_path = os.path.join(data_path, rel_path)
+        stream = STRUCTURED.open(full_path)
+        if stream is not None:
+            pending.append((rel_path, full_path, stream))
+        elif executor is None:
+            pending.append((rel_path, full_path, _timed_load(full_path)))
+        else:
+            pending.append((rel_path, full_path, executor.submit(_timed_load, full_path)))
+
+    try:
+        for _ in range(max_workers * 2):
+            submit_next()
+        while pending:
+            rel_path, full_path, result = pending.popleft()
+            ext = os.path.splitext(rel_path)[1].lower()
+            if isinstance(result, RecordStream):
+                submit_next()
+                yield rel_path, result
+                stats.add(ext, os.path.getsize(full_path), result.seconds, result.rows)
+                continue
+            docs, seconds = result if executor is None else result.result()
+            submit_next()
+            stats.add(ext, os.path.getsize(full_path), seconds, len(docs))
+            yield rel_path, docs
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        stats.report(time.perf_counter() - start)
+
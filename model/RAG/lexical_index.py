@@ -0,0 +1,448 @@
+'''BM25关键词倒排索引：中文按字的二元组切分，英文、数字、药品编码等按整词切分
+
+倒排表以按词排序的numpy数组（CSR）存放，每条倒排记录只占6字节（文本块编号int32 + 词频uint16），
+词本身编码成int64（汉字二元组由两个字的码位拼成，英文词取哈希），不为每个词或每条记录创建Python对象。
+新增的文本块写成新的一段倒排表，段数按大小成倍合并，保持在对数级别；删除只做标记，删除的文本块较多时再整体压缩。
+多个用户共用一个索引时，每个文本块记录所属用户的编号，每段倒排表内的文本块在合并时按用户重新编号，同一用户的编号连续；
+只检索一个用户时先二分查找出该用户在每段中的编号范围（跳过没有该用户文本块的段），再在每条倒排链上二分查找出这个范围，
+耗时只与该用户的文本块有关，与用户总数无关。
+保存后倒排表以内存映射方式加载，只读加载的多个进程共享同一份页缓存。
+'''
+import os
+import re
+import math
+import pickle
+import hashlib
+import itertools
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# 连续的字母数字（允许中间带.和-，如 E11.9、COVID-19）或连续的汉字
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*|[\u4e00-\u9fff]+")
+# 汉字二元组编码为 前一个字的码位 * _CODE_POINTS + 后一个字的码位，不会超过2^41
+_CODE_POINTS = 0x110000
+# 英文词的哈希置上这一位，与汉字的编码区分开
+_WORD_FLAG = 1 << 62
+_MAX_TF = np.iinfo(np.uint16).max
+# 不属于任何用户的文本块
+NO_OWNER = -1
+
+TERMS_FILE = "terms.npy"
+OFFSETS_FILE = "offsets.npy"
+DOCS_FILE = "docs.npy"
+TFS_FILE = "tfs.npy"
+LENGTHS_FILE = "lengths.npy"
+OWNERS_FILE = "owners.npy"
+IDS_FILE = "ids.pkl"
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        word = match.group()
+        if "\u4e00" <= word[0] <= "\u9fff":
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i : i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def term_key(term: str) -> int:
+    """词的int64编码，跨进程稳定，可以随索引保存"""
+    if "\u4e00" <= term[0] <= "\u9fff":
+        key = 0
+        for ch in term:
+            key = key * _CODE_POINTS + ord(ch)
+        return key
+    digest = hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest()
+    return _WORD_FLAG | (int.from_bytes(digest, "little") & (_WORD_FLAG - 1))
+
+
+def term_keys(text: str) -> List[int]:
+    """与tokenize切分方式相同，直接返回每个词的编码，汉字二元组不经过字符串"""
+    keys = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        word = match.group()
+        if "\u4e00" <= word[0] <= "\u9fff":
+            codes = [ord(ch) for ch in word]
+            if len(codes) == 1:
+                keys.append(codes[0])
+            else:
+                keys.extend(a * _CODE_POINTS + b for a, b in zip(codes, codes[1:]))
+        else:
+            keys.append(term_key(word))
+    return keys
+
+
+class _Postings(object):
+    """一段按词排序的倒排表：terms[i]的倒排链为 docs[offsets[i]:offsets[i+1]]（按文本块编号升序），tfs为对应的词频
+
+    这一段的文本块编号都在[start, end)内，其中同一用户的文本块编号连续。
+    """
+
+    __slots__ = ("terms", "offsets", "docs", "tfs", "start", "end")
+
+    def __init__(
+        self, terms: np.ndarray, offsets: np.ndarray, docs: np.ndarray, tfs: np.ndarray, start: int, end: int
+    ):
+        self.terms = terms
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return len(self.docs)
+
+    @classmethod
+    def build(cls, keys: np.ndarray, docs: np.ndarray, tfs: np.ndarray, start: int, end: int) -> "_Postings":
+        """输入按文本块编号升序排列，稳定排序后同一个词的倒排链仍按编号升序"""
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        terms, starts = np.unique(keys, return_index=True)
+        offsets = np.append(starts, len(keys)).astype(np.int64)
+        return cls(terms, offsets, docs[order], tfs[order], start, end)
+
+    def expand(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """展开成每条记录一个 (词, 文本块编号, 词频)，用于合并"""
+        return np.repeat(self.terms, np.diff(self.offsets)), self.docs, self.tfs
+
+    def lookup(self, key: int, docs_range: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """词的倒排链；docs_range不为None时只返回编号在这个范围内的一段"""
+        i = int(self.terms.searchsorted(key))
+        if i == len(self.terms) or self.terms[i] != key:
+            return self.docs[:0], self.tfs[:0]
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        if docs_range is not None:
+            docs = self.docs[start:end]
+            start, end = start + int(docs.searchsorted(docs_range[0])), start + int(docs.searchsorted(docs_range[1]))
+        return self.docs[start:end], self.tfs[start:end]
+
+
+def _merge(
+    segments: List[_Postings], start: int, end: int, numbers: Optional[np.ndarray] = None, offset: int = 0
+) -> _Postings:
+    """合并多段倒排表，合并后的编号范围为[start, end)；numbers不为None时文本块x的新编号为numbers[x - offset]，编号为-1的被丢弃"""
+    keys, docs, tfs = (np.concatenate(parts) for parts in zip(*(s.expand() for s in segments)))
+    if numbers is not None:
+        docs = numbers[docs - offset]
+        keep = docs >= 0
+        keys, docs, tfs = keys[keep], docs[keep].astype(np.int32), tfs[keep]
+        mapped = numbers[numbers >= 0]
+        if (mapped[1:] < mapped[:-1]).any():
+            # 按用户重新编号改变了先后顺序，先按新编号排序，build之后每条倒排链仍按编号升序
+            order = np.argsort(docs, kind="stable")
+            keys, docs, tfs = keys[order], docs[order], tfs[order]
+    return _Postings.build(keys, docs, tfs, start, end)
+
+
+class LexicalIndex(object):
+    """支持增量添加、删除和持久化的BM25索引，文档以向量库中的文本块id标识"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # 文本块编号 -> id（已删除的为None），以及反查表；编号只在索引内部使用，合并和压缩时重新分配
+        self._ids: List[Optional[str]] = []
+        self._numbers: Dict[str, int] = {}
+        # 按容量翻倍扩展，前len(_ids)项有效
+        self._lengths = np.zeros(0, dtype=np.int32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._owners = np.zeros(0, dtype=np.int32)
+        self._segments: List[_Postings] = []
+        self._total_len = 0
+        self._dead = 0
+        # 用户编号 -> [未删除的文本块数, 总词数]，只检索一个用户时按它计算BM25
+        self._owner_stats: Dict[int, List[int]] = {}
+
+    def __len__(self):
+        return len(self._numbers)
+
+    @property
+    def nbytes(self) -> int:
+        # 倒排记录每条6字节，每个词16字节，id到编号的映射每项约100字节
+        postings = sum(len(s) * 6 + len(s.terms) * 16 for s in self._segments)
+        return postings + len(self._ids) * 9 + len(self._numbers) * 100
+
+    def _reserve(self, count: int):
+        if count <= len(self._lengths):
+            return
+        capacity = max(1024, count, len(self._lengths) * 2)
+        size = len(self._ids)
+        self._lengths = np.concatenate([self._lengths[:size], np.zeros(capacity - size, dtype=np.int32)])
+        self._alive = np.concatenate([self._alive[:size], np.zeros(capacity - size, dtype=bool)])
+        self._owners = np.concatenate([self._owners[:size], np.full(capacity - size, NO_OWNER, dtype=np.int32)])
+
+    def add(self, ids: Iterable[str], texts: Iterable[str], owners: Optional[Iterable[int]] = None):
+        """owners为每个文本块所属用户的编号（由调用方分配的非负整数），不传时不属于任何用户"""
+        keys: List[int] = []
+        docs: List[int] = []
+        tfs: List[int] = []
+        if owners is None:
+            owners = itertools.repeat(NO_OWNER)
+        start = len(self._ids)
+        for id, text, owner in zip(ids, texts, owners):
+            # 已存在的id被新内容覆盖；这一批的编号已经分配，等加入倒排表后再压缩
+            self._forget(id)
+            number = len(self._ids)
+            counts = Counter(term_keys(text))
+            keys.extend(counts)
+            tfs.extend(counts.values())
+            docs.extend([number] * len(counts))
+            length = sum(counts.values())
+            self._reserve(number + 1)
+            self._lengths[number] = length
+            self._alive[number] = True
+            self._owners[number] = owner
+            self._ids.append(id)
+            self._numbers[id] = number
+            self._total_len += length
+            if owner != NO_OWNER:
+                stats = self._owner_stats.setdefault(owner, [0, 0])
+                stats[0] += 1
+                stats[1] += length
+        if keys:
+            self._append(keys, docs, tfs, start)
+        self._maybe_compact()
+
+    def _append(self, keys: List[int], docs: List[int], tfs: List[int], start: int):
+        segment = _Postings.build(
+            np.array(keys, dtype=np.int64),
+            np.array(docs, dtype=np.int32),
+            np.minimum(np.array(tfs, dtype=np.int64), _MAX_TF).astype(np.uint16),
+            start,
+            len(self._ids),
+        )
+        self._segments.append(self._grouped([segment]))
+        # 最后一段不小于前一段的一半时合并，段数保持在对数级别，每条记录平均只被合并对数次
+        while len(self._segments) > 1 and len(self._segments[-2]) <= 2 * len(self._segments[-1]):
+            last = self._segments.pop()
+            self._segments[-1] = self._grouped([self._segments[-1], last])
+
+    def _grouped(self, segments: List[_Postings]) -> _Postings:
+        """合并编号范围相邻的几段，其中的文本块按用户重新编号"""
+        start, end = segments[0].start, segments[-1].end
+        numbers = self._regroup(start, end)
+        if numbers is None and len(segments) == 1:
+            return segments[0]
+        return _merge(segments, start, end, numbers, start)
+
+    def _regroup(self, start: int, end: int) -> Optional[np.ndarray]:
+        """把编号在[start, end)内的文本块按所属用户重新编号，同一用户的保持原有顺序
+
+        返回numbers，文本块x的新编号为numbers[x - start]；已经按用户排好时不修改，返回None。
+        """
+        owners = self._owners[start:end]
+        if (owners[1:] >= owners[:-1]).all():
+            return None
+        order = np.argsort(owners, kind="stable")
+        numbers = np.empty(end - start, dtype=np.int64)
+        numbers[order] = np.arange(start, end)
+        self._lengths[start:end] = self._lengths[start:end][order]
+        self._alive[start:end] = self._alive[start:end][order]
+        self._owners[start:end] = owners[order]
+        ids = self._ids[start:end]
+        self._ids[start:end] = [ids[i] for i in order.tolist()]
+        for number in range(start, end):
+            id = self._ids[number]
+            if id is not None:
+                self._numbers[id] = number
+        return numbers
+
+    def remove(self, ids: Iterable[str]):
+        for id in ids:
+            self._forget(id)
+        self._maybe_compact()
+
+    def _forget(self, id: str):
+        number = self._numbers.pop(id, None)
+        if number is None:
+            return
+        self._ids[number] = None
+        self._alive[number] = False
+        self._total_len -= int(self._lengths[number])
+        self._dead += 1
+        owner = int(self._owners[number])
+        if owner != NO_OWNER:
+            stats = self._owner_stats[owner]
+            stats[0] -= 1
+            stats[1] -= int(self._lengths[number])
+            if stats[0] == 0:
+                del self._owner_stats[owner]
+
+    def _maybe_compact(self):
+        # 已删除的文本块超过剩余的四分之一时压缩，平均每次删除的代价与总数无关
+        if self._dead > max(1024, len(self._numbers) // 4):
+            self._compact()
+
+    def _compacted(self) -> Tuple[List[str], np.ndarray, np.ndarray, Optional[_Postings]]:
+        """去掉已删除的文本块并合并成一段，返回 (ids, 长度, 所属用户, 倒排表)，不修改当前索引"""
+        size = len(self._ids)
+        # 未删除的文本块按用户重新编号，同一用户的保持原有顺序
+        order = np.flatnonzero(self._alive[:size])
+        order = order[np.argsort(self._owners[order], kind="stable")]
+        numbers = np.full(size, -1, dtype=np.int64)
+        numbers[order] = np.arange(len(order))
+        ids = [self._ids[i] for i in order.tolist()]
+        lengths = self._lengths[order]
+        owners = self._owners[order]
+        if not self._segments:
+            return ids, lengths, owners, None
+        segment = self._segments[0]
+        if len(self._segments) == 1 and not self._dead and (segment.start, segment.end) == (0, size):
+            return ids, lengths, owners, segment
+        return ids, lengths, owners, _merge(self._segments, 0, len(ids), numbers)
+
+    def _compact(self):
+        ids, lengths, owners, postings = self._compacted()
+        self._ids = ids
+        self._numbers = {id: i for i, id in enumerate(ids)}
+        self._lengths = lengths.copy()
+        self._alive = np.ones(len(ids), dtype=bool)
+        self._owners = owners.copy()
+        self._segments = [postings] if postings is not None else []
+        self._dead = 0
+
+    def _scopes(self, owner: Optional[int]) -> List[Tuple[_Postings, Optional[Tuple[int, int]]]]:
+        """每段倒排表及其中owner的文本块编号范围，owner为None时不限制；没有该用户文本块的段不返回"""
+        if owner is None:
+            return [(segment, None) for segment in self._segments]
+        scopes = []
+        for segment in self._segments:
+            owners = self._owners[segment.start : segment.end]
+            first = segment.start + int(owners.searchsorted(owner))
+            last = segment.start + int(owners.searchsorted(owner, side="right"))
+            if first < last:
+                scopes.append((segment, (first, last)))
+        return scopes
+
+    def _postings(
+        self, key: int, scopes: List[Tuple[_Postings, Optional[Tuple[int, int]]]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        parts = [segment.lookup(key, docs_range) for segment, docs_range in scopes]
+        if not parts:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint16)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    def search(self, query: str, k: int, owner: Optional[int] = None) -> List[Tuple[str, float]]:
+        """返回BM25得分最高的k个 (文本块id, 得分)
+
+        owner不为None时只在该用户的文本块中检索，文本块数、平均长度和df也只按该用户统计，
+        与该用户单独一个索引时的得分相同。
+        """
+        if owner is None:
+            doc_count, total_len = len(self._numbers), self._total_len
+        else:
+            doc_count, total_len = self._owner_stats.get(owner, (0, 0))
+        if doc_count == 0 or k <= 0:
+            return []
+        avg_len = total_len / doc_count
+        alive = self._alive[: len(self._ids)]
+        scopes = self._scopes(owner)
+        matched_docs, matched_scores = [], []
+        for key in set(term_keys(query)):
+            docs, tfs = self._postings(key, scopes)
+            if self._dead:
+                keep = alive[docs]
+                docs, tfs = docs[keep], tfs[keep]
+            df = len(docs)
+            if df == 0:
+                continue
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            tfs = tfs.astype(np.float32)
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[docs] / avg_len)
+            matched_docs.append(docs)
+            matched_scores.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+        if not matched_docs:
+            return []
+        docs = np.concatenate(matched_docs)
+        weights = np.concatenate(matched_scores)
+        if owner is not None:
+            # 只有该用户的文本块，按命中的文本块重新编号后累加，不分配与整个索引一样大的数组
+            docs, inverse = np.unique(docs, return_inverse=True)
+            scores = np.bincount(inverse, weights=weights)
+            hits = np.arange(len(docs))
+            if len(hits) > k:
+                hits = hits[np.argpartition(-scores, k - 1)[:k]]
+            hits = hits[np.argsort(-scores[hits], kind="stable")]
+            return [(self._ids[docs[i]], float(scores[i])) for i in hits.tolist()]
+        # 同一文本块在各个词上的得分相加；得分都大于0，没有命中的文本块为0
+        scores = np.bincount(docs, weights=weights)
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(self._ids[i], float(scores[i])) for i in hits.tolist()]
+
+    def save(self, path: str):
+        """保存到目录，只写入未删除的文本块，写完后可用load以内存映射方式打开"""
+        os.makedirs(path, exist_ok=True)
+        ids, lengths, owners, postings = self._compacted()
+        if postings is None:
+            postings = _Postings(
+                np.zeros(0, dtype=np.int64),
+                np.zeros(1, dtype=np.int64),
+                np.zeros(0, dtype=np.int32),
+                np.zeros(0, dtype=np.uint16),
+                0,
+                0,
+            )
+        np.save(os.path.join(path, TERMS_FILE), postings.terms)
+        np.save(os.path.join(path, OFFSETS_FILE), postings.offsets)
+        np.save(os.path.join(path, DOCS_FILE), postings.docs)
+        np.save(os.path.join(path, TFS_FILE), postings.tfs)
+        np.save(os.path.join(path, LENGTHS_FILE), lengths)
+        np.save(os.path.join(path, OWNERS_FILE), owners)
+        with open(os.path.join(path, IDS_FILE), "wb") as f:
+            pickle.dump((self.k1, self.b, ids, self._total_len), f)
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        with open(os.path.join(path, IDS_FILE), "rb") as f:
+            k1, b, ids, total_len = pickle.load(f)
+        index = cls(k1, b)
+        index._ids = ids
+        index._numbers = {id: i for i, id in enumerate(ids)}
+        index._lengths = np.load(os.path.join(path, LENGTHS_FILE))
+        index._alive = np.ones(len(ids), dtype=bool)
+        index._total_len = total_len
+        owners_path = os.path.join(path, OWNERS_FILE)
+        if os.path.exists(owners_path):
+            index._owners = np.load(owners_path)
+            owned = index._owners != NO_OWNER
+            codes, inverse = np.unique(index._owners[owned], return_inverse=True)
+            counts = np.bincount(inverse, minlength=len(codes))
+            lengths = np.bincount(inverse, weights=index._lengths[owned], minlength=len(codes))
+            index._owner_stats = {
+                int(code): [int(count), int(length)] for code, count, length in zip(codes, counts, lengths)
+            }
+        else:
+            index._owners = np.full(len(ids), NO_OWNER, dtype=np.int32)
+        postings = _Postings(
+            *(
+                np.load(os.path.join(path, name), mmap_mode="r")
+                for name in (TERMS_FILE, OFFSETS_FILE, DOCS_FILE, TFS_FILE)
+            ),
+            0,
+            len(ids),
+        )
+        if len(postings):
+            index._segments = [postings]
+        return index
+
+
+def reciprocal_rank_scores(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """按倒数排名融合多路检索结果，返回按融合得分降序的 (id, 得分)，k越大排名靠后的结果权重越接近靠前的结果"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
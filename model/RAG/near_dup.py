@@ -0,0 +1,152 @@
+'''近似重复文本块检测：用MinHash估计文本块之间的Jaccard相似度，用LSH分桶快速找出候选
+
+文本按字符5-gram切分，签名取128个最小哈希，分成16段、每段8个，任意一段完全相同的文本块成为候选，
+再按签名中相同位置的比例估计Jaccard相似度，不低于阈值时视为重复。
+Jaccard为0.8、0.9的文本块成为候选的概率约为95%、99.99%。
+签名和分桶都存放在numpy数组中，每个文本块约占800字节，远小于一个768维向量（3KB）。
+'''
+import pickle
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+_SHINGLE = 5
+_NUM_PERM = 128
+_BANDS = 16
+_ROWS = _NUM_PERM // _BANDS
+# 签名随索引保存，哈希参数必须固定
+_RNG = np.random.default_rng(20240601)
+_A = _RNG.integers(1, 2**63, _NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_B = _RNG.integers(0, 2**63, _NUM_PERM, dtype=np.uint64)
+_BAND_MIX = _RNG.integers(1, 2**63, _ROWS, dtype=np.uint64) | np.uint64(1)
+# 不同段的哈希加上不同的偏移，所有段放在同一个有序数组中，一次二分查出所有段
+_BAND_SALT = _RNG.integers(0, 2**63, _BANDS, dtype=np.uint64)
+_BASE = np.uint64(1000003)
+
+
+def signature(text: str) -> Optional[np.ndarray]:
+    """文本的MinHash签名，空文本返回None"""
+    text = " ".join(text.split())
+    if not text:
+        return None
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    # 多项式滚动哈希，一次算出所有5-gram的哈希值；不足5个字时整段作为一个5-gram
+    width = min(_SHINGLE, len(codes))
+    count = len(codes) - width + 1
+    shingles = np.zeros(count, dtype=np.uint64)
+    for j in range(width):
+        shingles = shingles * _BASE + codes[j : j + count]
+    shingles = np.unique(shingles)
+    # 乘法移位哈希，每个排列取最小值；右移不改变大小顺序，先取最小值再移位，原地计算避免临时数组
+    hashes = np.multiply.outer(shingles, _A)
+    hashes += _B
+    return (hashes.min(axis=0) >> np.uint64(32)).astype(np.uint32)
+
+
+def band_keys(signatures: np.ndarray) -> np.ndarray:
+    """把签名的每一段压成一个uint64，形状为 (文本块数, 段数)"""
+    bands = signatures.reshape(-1, _BANDS, _ROWS).astype(np.uint64)
+    return (bands * _BAND_MIX).sum(axis=2) + _BAND_SALT
+
+
+class MinHashIndex(object):
+    """保存代表文本块的签名，查询一个文本块是否与已有的某个文本块近似重复
+
+    新加入的文本块先记在字典里，积累到已有数量的四分之一时再合并进排好序的分桶数组，平均每次加入的代价与总数无关。
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        # 按容量翻倍扩展，前len(ids)行有效
+        self._signatures = np.zeros((0, _NUM_PERM), dtype=np.uint32)
+        self._alive = np.zeros(0, dtype=bool)
+        # 所有段的 (段哈希, 行号)，按段哈希排序，查找时二分
+        self._keys = np.zeros(0, dtype=np.uint64)
+        self._positions = np.zeros(0, dtype=np.int64)
+        # 还没有合并进有序数组的文本块：段哈希 -> 行号
+        self._pending: Dict[int, List[int]] = {}
+        self._pending_count = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def find(self, text: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """返回 (重复的已有文本块id, 签名)；不重复时id为None，可以再用签名调用add"""
+        sig = signature(text)
+        if sig is None:
+            return None, None
+        keys = band_keys(sig[None, :])[0]
+        candidates = [
+            self._positions[lo:hi]
+            for lo, hi in zip(
+                self._keys.searchsorted(keys, "left").tolist(),
+                self._keys.searchsorted(keys, "right").tolist(),
+            )
+            if hi > lo
+        ]
+        if self._pending:
+            for key in keys.tolist():
+                pending = self._pending.get(key)
+                if pending:
+                    candidates.append(np.array(pending, dtype=np.int64))
+        if not candidates:
+            return None, sig
+        rows = np.unique(np.concatenate(candidates))
+        rows = rows[self._alive[rows]]
+        if len(rows) == 0:
+            return None, sig
+        similarity = (self._signatures[rows] == sig).mean(axis=1)
+        best = int(np.argmax(similarity))
+        if similarity[best] < self.threshold:
+            return None, sig
+        return self.ids[int(rows[best])], sig
+
+    def add(self, id: str, sig: np.ndarray):
+        row = len(self.ids)
+        if row == len(self._signatures):
+            capacity = max(1024, row * 2)
+            self._signatures = np.resize(self._signatures, (capacity, _NUM_PERM))
+            self._alive = np.concatenate([self._alive[:row], np.zeros(capacity - row, dtype=bool)])
+        self.ids.append(id)
+        self._rows[id] = row
+        self._signatures[row] = sig
+        self._alive[row] = True
+        for key in band_keys(sig[None, :])[0].tolist():
+            self._pending.setdefault(key, []).append(row)
+        self._pending_count += 1
+        if self._pending_count >= max(1024, row // 4):
+            self._rebuild_bands()
+
+    def remove(self, ids: List[str]):
+        # 只做标记，保存时再去掉
+        for id in ids:
+            row = self._rows.pop(id, None)
+            if row is not None:
+                self._alive[row] = False
+
+    def _rebuild_bands(self):
+        keys = band_keys(self._signatures[: len(self.ids)]).ravel()
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._positions = order // _BANDS
+        self._pending.clear()
+        self._pending_count = 0
+
+    def save(self, path: str):
+        alive = np.flatnonzero(self._alive[: len(self.ids)])
+        with open(path, "wb") as f:
+            pickle.dump((self.threshold, [self.ids[i] for i in alive], self._signatures[alive]), f)
+
+    @classmethod
+    def load(cls, path: str) -> "MinHashIndex":
+        with open(path, "rb") as f:
+            threshold, ids, signatures = pickle.load(f)
+        index = cls(threshold)
+        index.ids = ids
+        index._rows = {id: i for i, id in enumerate(ids)}
+        index._signatures = signatures
+        index._alive = np.ones(len(ids), dtype=bool)
+        index._rebuild_bands()
+        return index
@@ -0,0 +1,50 @@
+'''离线构建知识库索引：在多个进程中并行编码，保存到 Knowledge-index-path 后，在线服务启动时或只读进程检测到新版本时直接加载
+
+    python -m model.RAG.offline_build --workers 8 --threads 4
+
+与在线的 Retrievemodel.build() 使用同一套增量构建逻辑（只编码新增和修改的文件）和向量缓存。
+每批文本块切成分片分给各进程编码，结果按文本块原来的顺序拼回，生成的索引与单进程构建的一致。
+配置为只读模式（Knowledge-index-readonly: true）时同样可以运行，在线的只读进程会自动切换到新索引。
+'''
+import os
+import time
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--workers", type=int, default=0, help="编码进程数，0表示CPU核数除以每个进程的线程数")
+    parser.add_argument("--threads", type=int, default=4, help="每个编码进程使用的线程数")
+    parser.add_argument("--shard-size", type=int, default=64, help="每次分给一个进程编码的文本块数")
+    parser.add_argument("--rebuild", action="store_true", help="删除已有索引后完整重建")
+    args = parser.parse_args()
+    workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads)
+
+    # 在这里才导入：spawn启动的编码进程会重新导入本模块，子进程中不需要加载配置和检索模型
+    from config.config import Config
+    from model.Embedding.embedding_provider import INSTANCE as EMBEDDING_PROVIDER
+    from model.RAG.index_store import remove_index
+    from model.RAG.retrieve_model import Retrievemodel
+
+    if args.rebuild:
+        remove_index(Config.get_instance().get_with_nested_params("Knowledge-index-path"))
+    sharded = EMBEDDING_PROVIDER.start_workers(workers, args.threads, args.shard_size)
+    start = time.perf_counter()
+    try:
+        # 每批文本块数取进程数乘以分片大小，每个进程每批都分到一个完整分片
+        model = Retrievemodel(batch_size=sharded.batch_size, read_only=False)
+        model.build()
+    finally:
+        sharded.report()
+        sharded.close()
+    status = model.rebuild_status()
+    print(
+        f"离线构建完成，耗时 {time.perf_counter() - start:.1f}s，"
+        f"处理文件 {status['files-done']}/{status['files-total']}，编码文本块 {status['chunks']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
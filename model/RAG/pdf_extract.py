@@ -0,0 +1,234 @@
+'''PDF文本提取：知识库构建和对话中上传的PDF共用，页数多时按页分给多个进程并行提取，提取结果按文件内容的哈希缓存到磁盘
+
+同一个文件重复上传、改名或重建索引时直接读取缓存，不再解析。
+'''
+import io
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Iterator, List, Optional, Union
+
+from langchain_core.documents import Document
+from langchain_core.document_loaders import BaseLoader
+
+from config.config import Config
+
+try:
+    from pypdf import PdfReader, __version__ as _READER_VERSION
+
+    _READER_NAME = "pypdf"
+except ImportError:  # langchain的PyPDFLoader依赖pypdf，没有安装时使用requirements中的PyPDF2
+    from PyPDF2 import PdfReader, __version__ as _READER_VERSION
+
+    _READER_NAME = "PyPDF2"
+
+# 缓存键中带上解析库及其版本，升级解析库后重新提取
+_EXTRACTOR = f"{_READER_NAME}-{_READER_VERSION}"
+_READ_BLOCK = 1024 * 1024
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_READ_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _page_text(reader: PdfReader, index: int) -> str:
+    try:
+        return reader.pages[index].extract_text() or ""
+    except Exception as e:
+        print(f"提取PDF第{index + 1}页失败: {e}")
+        return ""
+
+
+def _extract_range(path: str, start: int, end: int) -> List[str]:
+    # 在子进程中执行，每个进程各自打开文件，只解析分到的页
+    reader = PdfReader(path)
+    return [_page_text(reader, i) for i in range(start, end)]
+
+
+class PdfTextCache(object):
+    """基于SQLite的提取结果缓存，以 (解析库版本, 文件内容哈希) 为键保存压缩后的各页文本，总大小超过上限时按最近访问时间淘汰"""
+
+    def __init__(self, path: str, max_size_mb: int):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._max_bytes = max_size_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pdf_text ("
+            " extractor TEXT NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " pages BLOB NOT NULL,"
+            " accessed REAL NOT NULL,"
+            " PRIMARY KEY (extractor, hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pdf_text_accessed ON pdf_text (accessed)")
+        self._conn.commit()
+
+    def get(self, hash: str) -> Optional[List[str]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT pages FROM pdf_text WHERE extractor = ? AND hash = ?", (_EXTRACTOR, hash)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE pdf_text SET accessed = ? WHERE extractor = ? AND hash = ?",
+                (time.time(), _EXTRACTOR, hash),
+            )
+            self._conn.commit()
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def put(self, hash: str, pages: List[str]):
+        data = zlib.compress(json.dumps(pages, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pdf_text (extractor, hash, pages, accessed) VALUES (?, ?, ?, ?)",
+                (_EXTRACTOR, hash, data, time.time()),
+            )
+            self._conn.commit()
+            self._evict()
+
+    def _evict(self):
+        # 超过上限时删除最久未访问的条目，直到降到上限的九成以下
+        page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        freelist = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        size = (page_count - freelist) * page_size
+        if size <= self._max_bytes:
+            return
+        count = self._conn.execute("SELECT COUNT(*) FROM pdf_text").fetchone()[0]
+        if count == 0:
+            return
+        remove = max(1, int(count * (1 - self._max_bytes * 0.9 / size)))
+        self._conn.execute(
+            "DELETE FROM pdf_text WHERE rowid IN ("
+            " SELECT rowid FROM pdf_text ORDER BY accessed LIMIT ?)",
+            (remove,),
+        )
+        self._conn.commit()
+        print(f"PDF文本缓存超过 {self._max_bytes // 1024 // 1024}MB，已淘汰 {remove} 个文件")
+
+
+class PdfExtractor(object):
+    """按页提取PDF文本，带内容哈希缓存；页数不少于parallel_min_pages时按页分段并行提取"""
+
+    def __init__(self, cache_path: str, cache_size_mb: int, parallel_min_pages: int, workers: int):
+        self._cache_path = cache_path
+        self._cache_size_mb = cache_size_mb
+        self._parallel_min_pages = parallel_min_pages
+        self._workers = workers or os.cpu_count() or 1
+        self._lock = threading.Lock()
+        # SQLite连接和进程池都不能在子进程中继续使用，按进程号分别创建
+        self._cache_pid = None
+        self._cache: Optional[PdfTextCache] = None
+        self._executor_pid = None
+        self._executor: Optional[Executor] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.pages = 0
+        self._extract_seconds = 0.0
+
+    def _get_cache(self) -> PdfTextCache:
+        with self._lock:
+            if self._cache_pid != os.getpid():
+                self._cache = PdfTextCache(self._cache_path, self._cache_size_mb)
+                self._cache_pid = os.getpid()
+            return self._cache
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor_pid != os.getpid():
+                # 与文档解析引擎使用相同的进程上下文，不在有多个线程的进程中直接fork
+                from model.RAG.ingest import process_context
+
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._workers, mp_context=process_context()
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def extract_pages(self, path: str) -> List[str]:
+        """返回各页的文本，顺序与页码一致"""
+        hash = file_hash(path)
+        cache = self._get_cache()
+        pages = cache.get(hash)
+        if pages is not None:
+            self.hits += 1
+            return pages
+
+        start = time.perf_counter()
+        reader = PdfReader(path)
+        page_count = len(reader.pages)
+        # 知识库构建时文件已经在多个进程中并行解析，子进程中不再按页并行
+        parallel = (
+            self._parallel_min_pages
+            and page_count >= self._parallel_min_pages
+            and self._workers > 1
+            and multiprocessing.parent_process() is None
+        )
+        if parallel:
+            step = -(-page_count // self._workers)
+            executor = self._get_executor()
+            futures = [
+                executor.submit(_extract_range, path, i, min(i + step, page_count))
+                for i in range(0, page_count, step)
+            ]
+            pages = [text for future in futures for text in future.result()]
+        else:
+            pages = [_page_text(reader, i) for i in range(page_count)]
+        seconds = time.perf_counter() - start
+
+        cache.put(hash, pages)
+        self.misses += 1
+        self.pages += page_count
+        self._extract_seconds += seconds
+        print(f"提取PDF {os.path.basename(path)}：{page_count} 页，耗时 {seconds:.2f}s" + ("（并行）" if parallel else ""))
+        return pages
+
+    def extract_text(self, pdf_file: Union[str, io.IOBase]) -> str:
+        """整个文件的文本，各页之间以换行分隔"""
+        path = pdf_file if isinstance(pdf_file, str) else pdf_file.name
+        return "\n".join(self.extract_pages(path))
+
+    def metrics(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit-ratio": round(self.hits / total, 4) if total else 0.0,
+            "pages-extracted": self.pages,
+            "pages-per-second": round(self.pages / self._extract_seconds, 1) if self._extract_seconds else 0.0,
+        }
+
+
+class PdfTextLoader(BaseLoader):
+    """替代PyPDFLoader的文档加载器，每页一个Document，metadata与PyPDFLoader相同（source、从0开始的page）"""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def lazy_load(self) -> Iterator[Document]:
+        for page, text in enumerate(INSTANCE.extract_pages(self.file_path)):
+            yield Document(page_content=text, metadata={"source": self.file_path, "page": page})
+
+
+INSTANCE = PdfExtractor(
+    Config.get_instance().get_with_nested_params("Pdf-extract", "cache-path"),
+    Config.get_instance().get_with_nested_params("Pdf-extract", "cache-size-mb"),
+    Config.get_instance().get_with_nested_params("Pdf-extract", "parallel-min-pages"),
+    Config.get_instance().get_with_nested_params("Pdf-extract", "workers"),
+)
@@ -0,0 +1,223 @@
+'''流式的 加载 -> 分块 -> 编码 -> 入库 流水线，按固定大小的批次处理，内存占用只与批次大小有关'''
+import os
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import TextSplitter
+from model.RAG.chunker import ParentChildSplitter
+from model.RAG.compact_docstore import CompactDocstore
+from model.RAG.file_manifest import chunk_id
+from model.RAG.hybrid_store import HybridFAISS
+from model.RAG.index_factory import IndexSpec
+from model.RAG.near_dup import MinHashIndex
+from model.RAG.structured import RecordStream
+
+
+class _ChunkBatch(object):
+    def __init__(self):
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self.ids: List[str] = []
+        self.vectors: List[List[float]] = []
+        # 父子分块时这批子块所属的父块
+        self.parents: Dict[str, Document] = {}
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, text: str, metadata: dict, id: str):
+        self.texts.append(text)
+        self.metadatas.append(metadata)
+        self.ids.append(id)
+
+    def extend(self, other: "_ChunkBatch"):
+        self.texts.extend(other.texts)
+        self.metadatas.extend(other.metadatas)
+        self.ids.extend(other.ids)
+        self.vectors.extend(other.vectors)
+        self.parents.update(other.parents)
+
+
+class IndexPipeline(object):
+    """把文件解析结果逐批编码后增量写入FAISS向量库
+
+    file_docs为 (相对路径, 文档列表) 的迭代器，通常来自 ingest_files。
+    text_splitter为 ParentChildSplitter 时只编码子块，父块随子块一起写入向量库。
+    文档列表为RecordStream（结构化数据）时每行记录直接作为一个文本块，不再分块。
+    需要训练的索引类型会先缓存 index_spec.train_size 个向量，训练后再一并写入。
+    dedup_threshold大于0时，与已有文本块MinHash相似度不低于阈值的文本块不再编码，记为已有文本块的别名；
+    结构化数据的每一行是独立的记录，不参与合并。
+    """
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        text_splitter: Union[TextSplitter, ParentChildSplitter],
+        batch_size: int,
+        index_spec: IndexSpec,
+        dedup_threshold: float = 0,
+    ):
+        self._embedding = embedding
+        self._text_splitter = text_splitter
+        self._batch_size = batch_size
+        self._index_spec = index_spec
+        self._dedup_threshold = dedup_threshold
+        # 最近一次run的近似重复合并统计
+        self.dedup_report: Optional[dict] = None
+
+    def run(
+        self,
+        vectorstore: Optional[HybridFAISS],
+        file_docs: Iterable[Tuple[str, Union[List[Document], RecordStream]]],
+        total_files: int = 0,
+        progress: Optional[Callable[[int, int, int], None]] = None,
+        owner: Optional[str] = None,
+    ) -> Tuple[Optional[HybridFAISS], Dict[str, List[str]]]:
+        """返回更新后的向量库（没有任何文本块且传入为None时仍为None）以及每个文件的文本块id
+
+        progress在每批编码完成后以 (已处理文件数, 文件总数, 已编码文本块数) 调用。
+        owner不为None时文本块写入多个用户共用的向量库：metadata["owner"]记为owner，文本块id按"owner/路径"生成。
+        """
+        self._progress = progress
+        file_chunk_ids: Dict[str, List[str]] = {}
+        batch = _ChunkBatch()
+        self._untrained = _ChunkBatch()
+        self._start = time.perf_counter()
+        self._batches = 0
+        self._chunks = 0
+        self._minhash = None
+        aliases: Dict[str, Tuple[str, str]] = {}
+        duplicates = Counter()
+        if self._dedup_threshold:
+            existing = vectorstore.minhash if vectorstore is not None else None
+            self._minhash = existing if existing is not None else MinHashIndex(self._dedup_threshold)
+
+        for rel_path, docs in file_docs:
+            ids = []
+            file_chunk_ids[rel_path] = ids
+            key = rel_path if owner is None else f"{owner}/{rel_path}"
+            dedup = self._minhash is not None
+            if isinstance(docs, RecordStream):
+                chunks = self._rows(key, docs, owner)
+                dedup = False
+            else:
+                if owner is not None:
+                    for doc in docs:
+                        doc.metadata["owner"] = owner
+                chunks = (
+                    (split.page_content, split.metadata, id, parent)
+                    for split, id, parent in self._split(key, docs)
+                )
+            for text, metadata, id, parent in chunks:
+                ids.append(id)
+                if dedup:
+                    canonical_id, sig = self._minhash.find(text)
+                    if canonical_id is not None:
+                        aliases[id] = (canonical_id, metadata.get("source", rel_path))
+                        duplicates[rel_path] += 1
+                        continue
+                    if sig is not None:
+                        self._minhash.add(id, sig)
+                batch.add(text, metadata, id)
+                if parent is not None:
+                    # 子块可能跨批次，父块记录在子块所在的每一批中
+                    batch.parents[metadata["parent_id"]] = parent
+                if len(batch) >= self._batch_size:
+                    vectorstore = self._flush(vectorstore, batch)
+                    batch = _ChunkBatch()
+                    self._report(len(file_chunk_ids), total_files)
+
+        if len(batch):
+            vectorstore = self._flush(vectorstore, batch)
+            self._report(len(file_chunk_ids), total_files)
+        if vectorstore is None and len(self._untrained):
+            # 文本块总数不足训练所需时，用已有的全部向量创建索引
+            vectorstore = self._create(self._untrained)
+        self._untrained = None
+        if vectorstore is not None and self._minhash is not None:
+            vectorstore.minhash = self._minhash
+            vectorstore.add_aliases(aliases)
+            self._report_dedup(vectorstore, duplicates)
+        return vectorstore, file_chunk_ids
+
+    def _split(
+        self, rel_path: str, docs: List[Document]
+    ) -> Iterable[Tuple[Document, str, Optional[Document]]]:
+        """返回要编码的 (文本块, id, 父块)；父子分块时子块id为 父块id-序号，否则父块为None"""
+        if not isinstance(self._text_splitter, ParentChildSplitter):
+            splits = self._text_splitter.split_documents(docs)
+            yield from ((split, chunk_id(rel_path, i), None) for i, split in enumerate(splits))
+            return
+        for i, (parent, children) in enumerate(self._text_splitter.split_documents(docs)):
+            parent_id = chunk_id(rel_path, i)
+            for j, child in enumerate(children):
+                child.metadata["parent_id"] = parent_id
+                yield child, f"{parent_id}-{j}", parent
+
+    def _rows(
+        self, rel_path: str, stream: RecordStream, owner: Optional[str]
+    ) -> Iterable[Tuple[str, dict, str, None]]:
+        for i, (text, metadata) in enumerate(stream):
+            if owner is not None:
+                metadata["owner"] = owner
+            yield text, metadata, chunk_id(rel_path, i), None
+
+    def _flush(self, vectorstore: Optional[HybridFAISS], batch: _ChunkBatch) -> Optional[HybridFAISS]:
+        batch.vectors = self._embedding.embed_documents(batch.texts)
+        self._batches += 1
+        self._chunks += len(batch)
+        if vectorstore is None:
+            self._untrained.extend(batch)
+            if len(self._untrained) < self._index_spec.train_size:
+                return None
+            vectorstore = self._create(self._untrained)
+            self._untrained = _ChunkBatch()
+            return vectorstore
+
+        vectorstore.add_parents(batch.parents)
+        vectorstore.add_embeddings(
+            list(zip(batch.texts, batch.vectors)), metadatas=batch.metadatas, ids=batch.ids
+        )
+        return vectorstore
+
+    def _create(self, batch: _ChunkBatch) -> HybridFAISS:
+        index = self._index_spec.create(np.asarray(batch.vectors, dtype=np.float32))
+        vectorstore = HybridFAISS(self._embedding, index, CompactDocstore(), {})
+        vectorstore.add_parents(batch.parents)
+        vectorstore.add_embeddings(
+            list(zip(batch.texts, batch.vectors)), metadatas=batch.metadatas, ids=batch.ids
+        )
+        return vectorstore
+
+    def _report_dedup(self, vectorstore: HybridFAISS, duplicates: Counter):
+        merged = sum(duplicates.values())
+        total = self._chunks + merged
+        self.dedup_report = {
+            "chunks": total,
+            "merged": merged,
+            "merged-ratio": round(merged / total, 4) if total else 0.0,
+            # 按未压缩的float32向量估算
+            "saved-mb": round(merged * vectorstore.index.d * 4 / 1024 / 1024, 2),
+            "aliases-total": len(vectorstore.aliases),
+            "top-files": duplicates.most_common(10),
+        }
+        print(
+            f"近似重复合并：本次 {total} 个文本块中 {merged} 个与已有文本块重复（{self.dedup_report['merged-ratio']:.1%}），"
+            f"未编码，节省向量约 {self.dedup_report['saved-mb']}MB；向量库中共有 {len(vectorstore.aliases)} 个重复文本块"
+        )
+        for rel_path, count in duplicates.most_common(5):
+            print(f"  {os.path.basename(rel_path)}：{count} 个文本块重复")
+
+    def _report(self, files_done: int, total_files: int):
+        elapsed = max(time.perf_counter() - self._start, 1e-6)
+        if self._progress is not None:
+            self._progress(files_done, total_files, self._chunks)
+        files = f"{files_done}/{total_files}" if total_files else f"{files_done}"
+        print(
+            f"已完成第 {self._batches} 批编码，文件 {files}，"
+            f"累计 {self._chunks} 个文本块，{self._chunks / elapsed:.1f} 块/s"
+        )
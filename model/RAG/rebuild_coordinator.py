@@ -0,0 +1,123 @@
+'''后台重建协调器：同一时间只运行一个构建，构建期间继续使用旧索引，并记录进度和耗时'''
+import time
+import threading
+import traceback
+from typing import Callable, Optional
+
+# 构建函数接收一个进度回调 progress(已处理文件数, 文件总数, 已编码文本块数)
+ProgressCallback = Callable[[int, int, int], None]
+
+
+class RebuildCoordinator(object):
+    """对一个构建函数做单飞控制
+
+    start() 在后台线程中构建并立即返回；构建进行中再次调用只会在当前构建结束后再补一次，
+    多次请求合并为一次。run() 启动构建并等待完成；已有构建在进行时它可能开始于这次调用之前，
+    同样补一次构建并等待补的这一次结束。
+    """
+
+    def __init__(self, name: str, build: Callable[[ProgressCallback], None]):
+        self._name = name
+        self._build = build
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._thread: Optional[threading.Thread] = None
+        self._pending = False
+        # 每完成一轮构建加一，run()据此判断自己等待的那一轮是否已经结束
+        self._generation = 0
+
+        self.builds = 0
+        self.files_done = 0
+        self.files_total = 0
+        self.chunks = 0
+        self.started_at: Optional[float] = None
+        self.last_duration = 0.0
+        self.last_finished_at: Optional[float] = None
+        self.last_error: Optional[BaseException] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def _start_locked(self):
+        self._thread = threading.Thread(
+            target=self._loop, name=f"rebuild-{self._name}", daemon=True
+        )
+        self._thread.start()
+
+    def start(self) -> bool:
+        """在后台开始构建，已有构建在进行时只记下需要再构建一次并返回False"""
+        with self._lock:
+            if self._thread is not None:
+                # 正在进行的构建可能开始于这次变化之前，结束后需要再构建一次
+                self._pending = True
+                return False
+            self._start_locked()
+            return True
+
+    def run(self):
+        """构建并等待完成；构建失败时抛出该次构建的异常"""
+        with self._lock:
+            if self._thread is None:
+                self._start_locked()
+                target = self._generation + 1
+            else:
+                # 正在进行的构建读到的可能是调用之前的请求，等它之后开始的那一轮
+                self._pending = True
+                target = self._generation + 2
+            while self._generation < target:
+                self._done.wait()
+            error = self.last_error
+        if error is not None:
+            raise error
+
+    def _progress(self, files_done: int, files_total: int, chunks: int):
+        self.files_done = files_done
+        self.files_total = files_total
+        self.chunks = chunks
+
+    def _loop(self):
+        while True:
+            self.started_at = time.time()
+            self.files_done = self.files_total = self.chunks = 0
+            error = None
+            try:
+                self._build(self._progress)
+            except Exception as e:
+                error = e
+                print(f"{self._name} 构建失败: {e}")
+                traceback.print_exc()
+            with self._lock:
+                self.last_duration = time.time() - self.started_at
+                self.last_finished_at = time.time()
+                self.last_error = error
+                self.started_at = None
+                self.builds += 1
+                self._generation += 1
+                print(f"{self._name} 构建结束，耗时 {self.last_duration:.1f}s")
+                if not self._pending:
+                    self._thread = None
+                    self._done.notify_all()
+                    return
+                self._pending = False
+                self._done.notify_all()
+
+    def status(self) -> dict:
+        with self._lock:
+            running = self._thread is not None
+            return {
+                "running": running,
+                "pending": self._pending,
+                "files-done": self.files_done,
+                "files-total": self.files_total,
+                "chunks": self.chunks,
+                "elapsed-s": round(time.time() - self.started_at, 1) if running and self.started_at else 0.0,
+                "builds": self.builds,
+                "last-duration-s": round(self.last_duration, 1),
+                "last-finished-at": (
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.last_finished_at))
+                    if self.last_finished_at
+                    else None
+                ),
+                "last-error": str(self.last_error) if self.last_error else None,
+            }
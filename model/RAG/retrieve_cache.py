@@ -0,0 +1,133 @@
+'''检索缓存：缓存问题的查询向量和检索到的文本块id及相似度，索引更新后旧结果自动失效'''
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional
+
+from langchain_core.documents import Document
+
+from model.RAG.hybrid_store import HybridFAISS, HybridRetriever
+
+# mmr、按阈值检索等仍走retriever本身，不经过缓存
+_CACHEABLE_SEARCH_TYPES = ("similarity", "hybrid")
+
+
+def normalize_query(query: str) -> str:
+    """全角转半角、统一大小写并合并空白，让只差标点宽度或空格的问题命中同一条缓存"""
+    query = unicodedata.normalize("NFKC", query)
+    return " ".join(query.lower().split())
+
+
+class LRUTTLCache(object):
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self._ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RetrievalCache(object):
+    """键为 (用户范围, 向量库generation, 向量库version, 检索方式, 归一化的问题)
+
+    多个用户共用一个向量库时，version只随该用户（search_kwargs中的owner）的文本块变化。
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._vectors = LRUTTLCache(max_entries, ttl_seconds)
+        self._results = LRUTTLCache(max_entries, ttl_seconds)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.vector_hits = 0
+        self._miss_seconds = 0.0
+        self._saved_seconds = 0.0
+
+    def query_vector(self, store: HybridFAISS, query: str) -> List[float]:
+        """问题的查询向量，按归一化的问题缓存；同一个问题检索多个向量库时只编码一次"""
+        normalized = normalize_query(query)
+        vector = self._vectors.get(normalized)
+        if vector is None:
+            vector = store._embed_query(normalized)
+            self._vectors.put(normalized, vector)
+        else:
+            with self._lock:
+                self.vector_hits += 1
+        return vector
+
+    def retrieve(
+        self,
+        scope: str,
+        retriever: HybridRetriever,
+        query: str,
+        vector: Optional[List[float]] = None,
+    ) -> List[Document]:
+        """vector为已经编码好的查询向量，不传时从缓存中取或编码"""
+        store = retriever.vectorstore
+        if retriever.search_type not in _CACHEABLE_SEARCH_TYPES or not hasattr(store, "version"):
+            return retriever.invoke(query)
+
+        start = time.perf_counter()
+        search_kwargs = retriever.search_kwargs
+        normalized = normalize_query(query)
+        key = (
+            scope,
+            store.generation,
+            store.scope_version(search_kwargs.get("owner")),
+            retriever.search_type,
+            tuple(sorted(search_kwargs.items())),
+            normalized,
+        )
+
+        results = self._results.get(key)
+        if results is not None:
+            docs = store.get_documents(results, **search_kwargs)
+            with self._lock:
+                self.hits += 1
+                avg_miss = self._miss_seconds / self.misses if self.misses else 0.0
+                self._saved_seconds += max(avg_miss - (time.perf_counter() - start), 0.0)
+            return docs
+
+        if vector is None:
+            vector = self.query_vector(store, normalized)
+        results = store.retrieve_ids(normalized, vector, retriever.search_type, **search_kwargs)
+        self._results.put(key, results)
+        with self._lock:
+            self.misses += 1
+            self._miss_seconds += time.perf_counter() - start
+        return store.get_documents(results, **search_kwargs)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._results),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit-ratio": round(self.hits / total, 4) if total else 0.0,
+                "query-vector-hits": self.vector_hits,
+                "avg-miss-ms": round(self._miss_seconds / self.misses * 1000, 2) if self.misses else 0.0,
+                "saved-seconds": round(self._saved_seconds, 3),
+            }
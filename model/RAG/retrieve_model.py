@@ -1,315 +1,562 @@
 '''本地知识库的RAG检索模型类'''
 from model.model_base import Modelbase
 from model.model_base import ModelStatus
+from model.RAG.index_store import (
+    build_manifest,
+    save_index,
+    load_index,
+    read_file_records,
+    index_version,
+)
+from model.RAG.file_manifest import FileRecord, scan_files, diff_files
+from model.RAG.ingest import FILE_LOADERS, ingest_files
+from model.RAG.structured import INSTANCE as STRUCTURED
+from model.RAG.pipeline import IndexPipeline
+from model.RAG.chunker import ChunkSpec
+from model.RAG.index_factory import IndexSpec, supports_removal
+from model.RAG.user_index_cache import UserIndexCache
+from model.RAG.tenant_index import TenantIndex
+from model.RAG.rebuild_coordinator import RebuildCoordinator
+from model.RAG.dir_watcher import DirectoryWatcher
+from model.Embedding.embedding_provider import SHARED_EMBEDDING
 from config.config import Config
 from env import get_app_root
 
 import os
-import shutil
+import atexit
+import dataclasses
+import threading
+from typing import Dict, List, Optional, Set
 import markdown  # pip install markdown
 import unstructured  # pip install unstructured
 import docx  # pip install python-docx
 
-from langchain_community.embeddings import ModelScopeEmbeddings
 from langchain_core.vectorstores import VectorStoreRetriever
-from langchain_community.document_loaders import (
-    DirectoryLoader,
-    PyPDFLoader,
-    JSONLoader,
-    MHTMLLoader,
-    TextLoader,
-    CSVLoader,
-)
-from langchain_community.document_loaders import (
-    UnstructuredWordDocumentLoader,
-    UnstructuredHTMLLoader,
-    UnstructuredMarkdownLoader,
-)
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores.faiss import FAISS
-from modelscope.hub.snapshot_download import snapshot_download
+
+
+def _rescan(data_path: str, records: Dict[str, FileRecord], changed_paths: Set[str]) -> List[str]:
+    """在清单的基础上只检查变化的路径，返回目录中当前所有支持格式文件的相对路径"""
+    rel_paths = set(records)
+    for path in changed_paths:
+        full_path = os.path.join(data_path, path)
+        if path in rel_paths:
+            rel_paths.discard(path)
+        else:
+            # 可能是被删除或移走的目录，去掉其中的文件
+            prefix = path + "/"
+            rel_paths -= {p for p in rel_paths if p.startswith(prefix)}
+        if os.path.isdir(full_path):
+            rel_paths.update(path + "/" + p for p in scan_files(full_path, FILE_LOADERS))
+        elif os.path.isfile(full_path) and os.path.splitext(path)[1].lower() in FILE_LOADERS:
+            rel_paths.add(path)
+    return sorted(rel_paths)
 
 
 # 检索模型
 class Retrievemodel(Modelbase):
 
-    _retriever: VectorStoreRetriever
+    _retriever: Optional[VectorStoreRetriever]
 
-    def __init__(self, *args, **krgs):
+    def __init__(self, *args, batch_size: int = None, read_only: bool = None, **krgs):
         super().__init__(*args, **krgs)
 
-        # 此处请自行改成下载embedding模型的位置
-        self._embedding_download_path = Config.get_instance().get_with_nested_params(
-            "model", "embedding", "model-path"
-        )
         self._embedding_model_name = Config.get_instance().get_with_nested_params(
             "model", "embedding", "model-name"
         )
-        self._embedding_model_path = os.path.join(
-            self._embedding_download_path, self._embedding_model_name
-        )
-        if not os.path.exists(self._embedding_model_path):
-            try:
-                # 如果为空，则从modelscope下载模型
-                model_dir = snapshot_download(
-                    self._embedding_model_name,
-                    cache_dir=self._embedding_download_path,
-                )
-                print(f"Model downloaded and saved to {model_dir}")
-            except Exception as e:
-                print(f"Failed to download model: {e}")
-                if os.path.exists(self._embedding_model_path):
-                    shutil.rmtree(self._embedding_model_path)
-        # self._loader = PyPDFDirectoryLoader
-        self._text_splitter = RecursiveCharacterTextSplitter
         # self._embedding = OpenAIEmbeddings()
-        self._embedding = ModelScopeEmbeddings(model_id=self._embedding_model_path)
+        # 进程内共享、首次使用时才加载的编码模型，编码前先查询向量缓存
+        self._embedding = SHARED_EMBEDDING
         self._data_path = Config.get_instance().get_with_nested_params(
             "Knowledge-base-path"
         )
         if not os.path.exists(self._data_path):
             os.makedirs(self._data_path)
-        self._user_retrievers = {}
-
-
-    # 建立向量库
-    def build(self):
-
-        # 加载PDF文件
-        pdf_loader = DirectoryLoader(
-            self._data_path,
-            glob="**/*.pdf",
-            loader_cls=PyPDFLoader,
-            silent_errors=True,
-            use_multithreading=True,
+        # 知识库向量索引的保存目录，启动时优先从这里加载
+        self._index_path = Config.get_instance().get_with_nested_params(
+            "Knowledge-index-path"
+        )
+        # 只读模式下只加载其他进程构建好的索引，并在索引更新后重新加载
+        self._read_only = (
+            read_only
+            if read_only is not None
+            else Config.get_instance().get_with_nested_params("Knowledge-index-readonly")
+        )
+        self._loaded_version = None
+        # 分块方式和长度，sentence方式用小块编码检索、返回所在的段落
+        self._chunk_spec = ChunkSpec.from_config()
+        # 检索方式：similarity 仅向量检索，hybrid 向量与BM25关键词检索融合
+        self._search_type = Config.get_instance().get_with_nested_params(
+            "model", "embedding", "search-type"
+        )
+        self._fetch_k = Config.get_instance().get_with_nested_params(
+            "model", "embedding", "fetch-k"
         )
-        pdf_docs = pdf_loader.load()
-
-        # 加载Word文件
-        docx_loader = DirectoryLoader(
-            self._data_path,
-            glob="**/*.docx",
-            loader_cls=UnstructuredWordDocumentLoader,
-            silent_errors=True,
-            use_multithreading=True,
+        # 是否对检索结果做MMR多样化和重叠去重
+        self._diversify = Config.get_instance().get_with_nested_params(
+            "model", "embedding", "diversify"
         )
-        docx_docs = docx_loader.load()
-
-        # 加载txt文件
-        txt_loader = DirectoryLoader(
-            self._data_path,
-            glob="**/*.txt",
-            loader_cls=TextLoader,
-            silent_errors=True,
-            loader_kwargs={"autodetect_encoding": True},
-            use_multithreading=True,
+        self._mmr_lambda = Config.get_instance().get_with_nested_params(
+            "model", "embedding", "mmr-lambda"
         )
-        txt_docs = txt_loader.load()
-
-        # 加载csv文件
-        csv_loader = DirectoryLoader(
-            self._data_path,
-            glob="**/*.csv",
-            loader_cls=CSVLoader,
-            silent_errors=True,
-            loader_kwargs={"autodetect_encoding": True},
-            use_multithreading=True,
+        # 相似度阈值，0表示不启用；启用时返回min_k到k个结果，没有结果达到阈值时返回空列表
+        self._score_threshold = Config.get_instance().get_with_nested_params(
+            "model", "embedding", "score-threshold"
         )
-        csv_docs = csv_loader.load()
-
-        # 加载html文件
-        html_loader = DirectoryLoader(
-            self._data_path,
-            glob="**/*.html",
-            loader_cls=UnstructuredHTMLLoader,
-            silent_errors=True,
-            use_multithreading=True,
+        self._min_k = Config.get_instance().get_with_nested_params(
+            "model", "embedding", "min-k"
         )
-        html_docs = html_loader.load()
-
-        mhtml_loader = DirectoryLoader(
-            self._data_path,
-            glob="**/*.mhtml",
-            loader_cls=MHTMLLoader,
-            silent_errors=True,
-            use_multithreading=True,
+        # 向量索引类型，知识库和用户向量库使用同一配置
+        self._index_spec = IndexSpec.from_config()
+        # 知识库近似重复文本块合并的MinHash相似度阈值，0表示不合并
+        self._dedup_threshold = Config.get_instance().get_with_nested_params(
+            "model", "embedding", "dedup-threshold"
         )
-        mhtml_docs = mhtml_loader.load()
-
-        # 加载markdown文件
-        markdown_loader = DirectoryLoader(
-            self._data_path,
-            glob="**/*.md",
-            loader_cls=UnstructuredMarkdownLoader,
-            silent_errors=True,
-            use_multithreading=True,
+        self._dedup_report = None
+        self._manifest = build_manifest(
+            self._embedding_model_name,
+            Config.get_instance().get_with_nested_params(
+                "model", "embedding", "model-version"
+            ),
+            self._chunk_spec,
+            self._index_spec,
+            STRUCTURED,
+            self._dedup_threshold,
         )
-        markdown_docs = markdown_loader.load()
-
-        # 要利用json数据要设置jq语句和content_key提取特定字段，这在不同json数据结构中有所不同，较为繁琐。
-        # 官方文档：https://api.python.langchain.com/en/latest/document_loaders/langchain_community.document_loaders.json_loader.JSONLoader.html
-        # json_loader = DirectoryLoader(self._data_path, glob="**/*.json", loader_kwargs={"jq_schema": ".","text_content":False},loader_cls=JSONLoader, silent_errors=True)
-        # json_docs = json_loader.load()
-
-        # 合并文档
-        docs = (
-            pdf_docs
-            + docx_docs
-            + txt_docs
-            + csv_docs
-            + html_docs
-            + mhtml_docs
-            + markdown_docs
+        # 解析文档的并行进程数，0表示使用全部CPU核心
+        self._ingest_workers = Config.get_instance().get_with_nested_params(
+            "model", "embedding", "ingest-workers"
         )
+        # 每批编码并写入向量库的文本块数，决定构建时的峰值内存；离线多进程构建时按进程数放大
+        self._batch_size = batch_size or Config.get_instance().get_with_nested_params(
+            "model", "embedding", "batch-size"
+        )
+        # 只读模式下还没有可加载的索引、或知识库中没有文档时为None
+        self._retriever = None
+        self._file_records = {}
+        self._publish_lock = threading.Lock()
+        # 下一次构建是否完整扫描知识库目录；目录监听只提供变化的路径，只检查这些路径
+        self._changes_lock = threading.Lock()
+        self._full_scan = True
+        self._changed_paths: Set[str] = set()
+        # 同一时间只运行一个构建，构建期间继续使用旧的retriever
+        self._rebuilds = RebuildCoordinator("知识库索引", self._rebuild)
+        # 用户向量库及每个文件对应的文本块id，超出内存预算时按LRU写到磁盘
+        # 上传、删除和目录监听可能同时更新同一个用户的向量库
+        self._user_lock = threading.RLock()
+        # per-user 每个用户一个向量库，超出内存预算时按LRU写到磁盘；shared 所有用户共用一个向量库，按用户过滤检索
+        self._shared_user_index = (
+            Config.get_instance().get_with_nested_params("model", "embedding", "user-index-mode")
+            == "shared"
+        )
+        if self._shared_user_index:
+            self._user_indexes = TenantIndex(
+                Config.get_instance().get_with_nested_params("User-index-path"),
+                self._embedding,
+                self._manifest,
+                self._index_spec,
+                self._as_retriever,
+            )
+        else:
+            self._user_indexes = UserIndexCache(
+                Config.get_instance().get_with_nested_params("User-index-path"),
+                Config.get_instance().get_with_nested_params(
+                    "model", "embedding", "user-index-cache-mb"
+                ),
+                self._embedding,
+                self._manifest,
+                self._index_spec,
+                self._as_retriever,
+            )
+        atexit.register(self._user_indexes.flush)
+
+        # 监听知识库目录和用户文件夹，文件变化后几秒内增量更新索引；由启动脚本调用start_watching开始监听，
+        # 解析进程池的子进程也会导入本模块，不能在导入时启动
+        self._watchers: List[DirectoryWatcher] = []
+        self._watch_enabled = Config.get_instance().get_with_nested_params("Knowledge-watch", "enabled")
+
+    # 建立向量库：只解析和编码新增或修改过的文件，并从向量库中删除已删除文件的文本块
+    def build(self):
+        """同步构建并等待完成；已有构建在进行时等待它结束，不会重复构建"""
+        with self._changes_lock:
+            self._full_scan = True
+        self._rebuilds.run()
+
+    def rebuild_in_background(self) -> bool:
+        """在后台构建，期间继续使用旧的retriever，完成后原子地切换；已有构建在进行时返回False"""
+        with self._changes_lock:
+            self._full_scan = True
+        return self._rebuilds.start()
+
+    def update_files(self, rel_paths: List[str]) -> bool:
+        """知识库中这些路径（相对知识库目录，可以是目录）发生了变化，在后台只检查它们并增量更新"""
+        with self._changes_lock:
+            self._changed_paths.update(rel_paths)
+        return self._rebuilds.start()
+
+    def rebuild_status(self) -> dict:
+        """当前或上一次构建的进度、耗时和错误"""
+        return self._rebuilds.status()
+
+    def dedup_report(self) -> dict:
+        """上一次构建合并的近似重复文本块数、节省的向量内存以及重复最多的文件"""
+        if self._dedup_report is None:
+            return {"enabled": bool(self._dedup_threshold)}
+        return {"enabled": True, "threshold": self._dedup_threshold, **self._dedup_report}
+
+    def start_watching(self):
+        """监听知识库目录和用户文件夹，变化合并后增量更新对应的向量库；只读模式下只监听用户文件夹，配置中未启用时不监听"""
+        if self._watchers or not self._watch_enabled:
+            return
+        debounce = Config.get_instance().get_with_nested_params("Knowledge-watch", "debounce-s")
+        poll_interval = Config.get_instance().get_with_nested_params(
+            "Knowledge-watch", "poll-interval-s"
+        )
+        if not self._read_only:
+            self._watchers.append(
+                DirectoryWatcher("知识库目录", self._data_path, self.update_files, debounce, poll_interval)
+            )
+        self._watchers.append(
+            DirectoryWatcher("用户文件夹", "user_data", self._on_user_data_change, debounce, poll_interval)
+        )
+        for watcher in self._watchers:
+            watcher.start()
+
+    def stop_watching(self):
+        for watcher in self._watchers:
+            watcher.stop()
+        self._watchers = []
+
+    def watch_status(self) -> Dict[str, dict]:
+        """各个目录监听的事件数和已处理的批次"""
+        return {watcher.name: watcher.status() for watcher in self._watchers}
+
+    def _publish(self, vectorstore, file_records, version):
+        # 一次性切换到新的向量库，检索请求要么用旧的、要么用新的
+        with self._publish_lock:
+            self._retriever = self._as_retriever(vectorstore)
+            self._file_records = file_records
+            self._loaded_version = version
+            self._model_status = ModelStatus.READY
+
+    def _rebuild(self, progress):
+        if self._read_only:
+            if not self.load():
+                print(f"只读模式下未能加载索引 {self._index_path}，等待构建进程生成")
+            return
 
-        # 创建一个 RecursiveCharacterTextSplitter 对象，用于将文档分割成块，chunk_size为最大块大小，chunk_overlap块之间可以重叠的大小
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=2000, chunk_overlap=100
+        with self._changes_lock:
+            full_scan, changed_paths = self._full_scan, self._changed_paths
+            self._full_scan, self._changed_paths = False, set()
+        try:
+            self._update_index(progress, full_scan, changed_paths)
+        except Exception:
+            # 失败时保留这次要处理的变化，下一次构建重新处理
+            with self._changes_lock:
+                self._full_scan = self._full_scan or full_scan
+                self._changed_paths |= changed_paths
+            raise
+
+    def _update_index(self, progress, full_scan: bool, changed_paths: Set[str]):
+        # 增量更新直接修改正在服务的向量库，每次增删都持有向量库的锁，检索不会读到一半写入的状态；
+        # 整体重建时在新的向量库上进行，完成后再切换
+        if self._model_status == ModelStatus.READY:
+            current = self._retriever.vectorstore
+            file_records = self._file_records
+            vectorstore = None
+        else:
+            # 首次构建时先加载磁盘上的索引，在其基础上增量更新
+            current = None
+            vectorstore = load_index(
+                self._index_path, self._embedding, self._manifest, self._index_spec
+            )
+            file_records = read_file_records(self._index_path) if vectorstore is not None else {}
+
+        diff = None
+        if current is not None and not full_scan:
+            # 其余文件沿用清单中的记录，不再遍历整个目录
+            rel_paths = _rescan(self._data_path, file_records, changed_paths)
+            try:
+                diff, new_records = diff_files(self._data_path, file_records, rel_paths)
+            except FileNotFoundError:
+                # 有文件在没有收到事件的情况下被删除，退回完整扫描
+                pass
+        if diff is None:
+            rel_paths = scan_files(self._data_path, FILE_LOADERS)
+            diff, new_records = diff_files(self._data_path, file_records, rel_paths)
+        existing = current if current is not None else vectorstore
+        index = existing.index if existing is not None else None
+        rebuild = index is not None and self._index_spec.should_rebuild(index)
+        if rebuild:
+            # 向量来自缓存，按完整的聚类数重新训练的代价很小
+            print("知识库文本块已足够多，按配置的聚类数重建索引")
+        elif index is not None and (diff.modified or diff.removed) and not supports_removal(index):
+            print("当前索引类型不支持删除向量，整体重建索引")
+            rebuild = True
+
+        if index is not None and not rebuild and not diff.changed:
+            print("知识库文件没有变化")
+            if current is None:
+                self._publish(vectorstore, new_records, index_version(self._index_path))
+            return
+        if rebuild:
+            vectorstore, file_records = None, {}
+            diff, new_records = diff_files(self._data_path, file_records, rel_paths)
+        elif current is not None:
+            # 不再从磁盘加载第二份副本，耗时和内存只与变化的文件有关；
+            # 删除旧文本块到写入新文本块之间的检索暂时看不到被修改的文件
+            vectorstore = current
+        print(
+            f"知识库文件变化：新增 {len(diff.added)}，修改 {len(diff.modified)}，"
+            f"删除 {len(diff.removed)}，未变 {len(diff.unchanged)}"
         )
-        splits = text_splitter.split_documents(docs)
 
-        # 使用 FAISS 创建一个向量数据库，存储分割后的文档及其嵌入向量
-        vectorstore = FAISS.from_documents(documents=splits, embedding=self._embedding)
+        try:
+            vectorstore, file_chunk_ids = self._apply_changes(vectorstore, file_records, diff, new_records, progress)
+        except Exception:
+            if current is not None and vectorstore is current:
+                # 正在服务的向量库只更新了一部分，恢复为磁盘上与文件清单一致的上一个版本
+                print("知识库增量更新失败，重新加载上一个版本的索引")
+                self.load()
+            raise
+        for rel_path, chunk_ids in file_chunk_ids.items():
+            new_records[rel_path].chunk_ids = chunk_ids
+
+        if vectorstore is None:
+            print(f"知识库 {self._data_path} 中没有可用的文档")
+            return
+
+        # 保存到磁盘，下次启动时直接加载，不必重新编码
+        if new_records != file_records or not os.path.exists(self._index_path):
+            save_index(vectorstore, self._index_path, self._manifest, new_records)
         # 将向量存储转换为检索器，设置检索参数 k 为 6，即返回最相似的 6 个文档
-        self._retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
+        self._publish(vectorstore, new_records, index_version(self._index_path))
+
+    def _apply_changes(self, vectorstore, file_records, diff, new_records, progress):
+        """删除被修改和被删除文件的旧文本块，再编码新增和修改的文件，返回 (向量库, 每个文件的文本块id)"""
+        if vectorstore is not None and diff.changed:
+            # 先删除被修改和被删除文件的旧文本块
+            stale_ids = []
+            for rel_path in diff.modified + diff.removed:
+                stale_ids.extend(file_records[rel_path].chunk_ids)
+            # 被删除的文本块是其他文件中重复文本块的代表时，这些文件一起重新编码，重复的文本块由其中一个成为新的代表
+            # 重新编码的文件中的文本块又可能是其他文件的代表，直到没有新的文件为止
+            reindexed = 0
+            while True:
+                orphans = set(vectorstore.aliases_of(stale_ids)) - set(stale_ids)
+                rel_paths = [p for p in diff.unchanged if orphans.intersection(new_records[p].chunk_ids)]
+                if not rel_paths:
+                    break
+                for rel_path in rel_paths:
+                    diff.unchanged.remove(rel_path)
+                    diff.modified.append(rel_path)
+                    stale_ids.extend(new_records[rel_path].chunk_ids)
+                    # 复制一份再更新chunk_ids，不修改正在服务的文件清单
+                    new_records[rel_path] = dataclasses.replace(new_records[rel_path])
+                reindexed += len(rel_paths)
+            if reindexed:
+                diff.modified.sort()
+                print(f"有重复文本块的代表被删除，{reindexed} 个文件重新编码")
+            existing_ids = set(vectorstore.index_to_docstore_id.values()) | set(vectorstore.aliases)
+            stale_ids = [i for i in stale_ids if i in existing_ids]
+            if stale_ids:
+                vectorstore.delete(stale_ids)
+
+        # 逐批解析、分块、编码并写入向量库，内存占用只与批次大小有关
+        changed_paths = diff.added + diff.modified
+        pipeline = self._pipeline(dedup=True)
+        vectorstore, file_chunk_ids = pipeline.run(
+            vectorstore,
+            ingest_files(self._data_path, changed_paths, self._ingest_workers),
+            len(changed_paths),
+            progress,
+        )
+        if pipeline.dedup_report is not None:
+            self._dedup_report = pipeline.dedup_report
+        return vectorstore, file_chunk_ids
+
+    # 从磁盘加载向量库（不检查文件变化），清单与当前配置不一致时返回False
+    def load(self) -> bool:
+        version = index_version(self._index_path)
+        vectorstore = load_index(
+            self._index_path,
+            self._embedding,
+            self._manifest,
+            self._index_spec,
+            read_only=self._read_only,
+        )
+        if vectorstore is None:
+            return False
+        self._publish(vectorstore, read_file_records(self._index_path), version)
+        return True
+
+    def _pipeline(self, index_spec: IndexSpec = None, dedup: bool = False) -> IndexPipeline:
+        # 只合并知识库中的重复文本块，用户文件各自独立
+        return IndexPipeline(
+            self._embedding,
+            self._chunk_spec.create(),
+            self._batch_size,
+            index_spec or self._index_spec,
+            self._dedup_threshold if dedup else 0,
+        )
 
-        # 设置模型状态为 BUILDING
-        self._model_status = ModelStatus.BUILDING
+    def _user_pipeline(self) -> IndexPipeline:
+        if self._shared_user_index:
+            return self._pipeline(self._user_indexes.index_spec)
+        return self._pipeline()
+
+    def _as_retriever(self, vectorstore, **extra_kwargs) -> VectorStoreRetriever:
+        # 混合检索时向量和关键词两路各召回fetch_k个候选，融合后取前k个
+        search_kwargs = {"k": 6, "fetch_k": self._fetch_k, **extra_kwargs}
+        if self._diversify:
+            search_kwargs.update(lambda_mult=self._mmr_lambda, dedup_overlap=True)
+        if self._score_threshold:
+            search_kwargs.update(score_threshold=self._score_threshold, min_k=self._min_k)
+        return vectorstore.as_retriever(
+            search_type=self._search_type, search_kwargs=search_kwargs
+        )
 
     @property
-    def retriever(self) -> VectorStoreRetriever:
+    def retriever(self) -> Optional[VectorStoreRetriever]:
+        """知识库的retriever，构建后仍没有可用的向量库时返回None"""
         if self._model_status == ModelStatus.FAILED:
+            # 还没有可用的向量库，只能等待构建完成；并发的请求会等待同一次构建
             self.build()
+            if self._retriever is None:
+                print(f"知识库索引 {self._index_path} 不可用，本次不检索知识库")
             return self._retriever
-        else:
-            return self._retriever
-
-    def build_user_vector_store(self):
-        """根据用户的ID加载用户文件夹中的文件并为用户构建向量库"""
-        user_data_path = os.path.join("user_data", self.user_id)  # 用户独立文件夹
+        if self._read_only and index_version(self._index_path) != self._loaded_version:
+            # 构建进程已切换到新版本，在后台重新映射，旧版本的文件在不再使用后由系统释放
+            self.rebuild_in_background()
+        return self._retriever
+
+    def build_user_vector_store(self, user_id=None):
+        """根据用户的ID加载用户文件夹中的文件并为用户构建向量库，不传user_id时为当前用户构建"""
+        user_id = user_id or self.user_id
+        user_data_path = os.path.join("user_data", user_id)  # 用户独立文件夹
         if not os.path.exists(user_data_path):
             print(f"用户文件夹 {user_data_path} 不存在")
             return
 
         try:
-            # 清理旧的向量库（如果已经存在）
-            if self.user_id in self._user_retrievers:
-                del self._user_retrievers[self.user_id]
-                print(f"用户 {self.user_id} 的旧向量库已删除")
-
-                # 加载用户文件夹中的文件并构建向量库
-                # 加载PDF文件
-            pdf_loader = DirectoryLoader(
-                user_data_path,
-                glob="**/*.pdf",
-                loader_cls=PyPDFLoader,
-                silent_errors=True,
-                use_multithreading=True,
-            )
-            pdf_docs = pdf_loader.load()
-
-            # 加载Word文件
-            docx_loader = DirectoryLoader(
-                user_data_path,
-                glob="**/*.docx",
-                loader_cls=UnstructuredWordDocumentLoader,
-                silent_errors=True,
-                use_multithreading=True,
-            )
-            docx_docs = docx_loader.load()
-
-            # 加载txt文件
-            txt_loader = DirectoryLoader(
-                user_data_path,
-                glob="**/*.txt",
-                loader_cls=TextLoader,
-                silent_errors=True,
-                loader_kwargs={"autodetect_encoding": True},
-                use_multithreading=True,
-            )
-            txt_docs = txt_loader.load()
-
-            # 加载csv文件
-            csv_loader = DirectoryLoader(
-                user_data_path,
-                glob="**/*.csv",
-                loader_cls=CSVLoader,
-                silent_errors=True,
-                loader_kwargs={"autodetect_encoding": True},
-                use_multithreading=True,
-            )
-            csv_docs = csv_loader.load()
-
-            # 加载html文件
-            html_loader = DirectoryLoader(
-                user_data_path,
-                glob="**/*.html",
-                loader_cls=UnstructuredHTMLLoader,
-                silent_errors=True,
-                use_multithreading=True,
-            )
-            html_docs = html_loader.load()
-
-            mhtml_loader = DirectoryLoader(
-                user_data_path,
-                glob="**/*.mhtml",
-                loader_cls=MHTMLLoader,
-                silent_errors=True,
-                use_multithreading=True,
-            )
-            mhtml_docs = mhtml_loader.load()
-
-            # 加载markdown文件
-            markdown_loader = DirectoryLoader(
-                user_data_path,
-                glob="**/*.md",
-                loader_cls=UnstructuredMarkdownLoader,
-                silent_errors=True,
-                use_multithreading=True,
-            )
-            markdown_docs = markdown_loader.load()
-
-            # 要利用json数据要设置jq语句和content_key提取特定字段，这在不同json数据结构中有所不同，较为繁琐。
-            # 官方文档：https://api.python.langchain.com/en/latest/document_loaders/langchain_community.document_loaders.json_loader.JSONLoader.html
-            # json_loader = DirectoryLoader(self._data_path, glob="**/*.json", loader_kwargs={"jq_schema": ".","text_content":False},loader_cls=JSONLoader, silent_errors=True)
-            # json_docs = json_loader.load()
-
-            # 合并文档
-            docs = (
-                pdf_docs
-                + docx_docs
-                + txt_docs
-                + csv_docs
-                + html_docs
-                + mhtml_docs
-                + markdown_docs
-            )
+            with self._user_lock:
+                # 清理旧的向量库（如果已经存在）
+                self._user_indexes.pop(user_id)
+
+                # 加载用户文件夹中的文件并构建向量库；共用向量库时写入共用的向量库并标记所属用户
+                rel_paths = scan_files(user_data_path, FILE_LOADERS)
+                _, file_records = diff_files(user_data_path, {}, rel_paths)
+                shared = self._shared_user_index
+                vectorstore, file_chunk_ids = self._user_pipeline().run(
+                    self._user_indexes.store if shared else None,
+                    ingest_files(user_data_path, rel_paths, self._ingest_workers),
+                    len(rel_paths),
+                    owner=user_id if shared else None,
+                )
 
-            if not docs:
-                print(f"用户 {self.user_id} 文件夹中没有找到文档")
-                return
+                if vectorstore is None:
+                    print(f"用户 {user_id} 文件夹中没有找到文档")
+                    return
 
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=2000, chunk_overlap=100
-            )
-            splits = text_splitter.split_documents(docs)
+                for rel_path, chunk_ids in file_chunk_ids.items():
+                    file_records[rel_path].chunk_ids = chunk_ids
+                user_retriever = self._as_retriever(vectorstore)
 
-            # 为该用户构建向量库
-            vectorstore = FAISS.from_documents(
-                documents=splits, embedding=self._embedding
-            )
-            user_retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
-
-            # 将用户的retriever存储到字典中
-            self._user_retrievers[self.user_id] = user_retriever
-            print(f"用户 {self.user_id} 的向量库已构建完成")
+                # 将用户的retriever及每个文件的文本块id存入缓存
+                self._user_indexes.put(user_id, user_retriever, file_records)
+            print(f"用户 {user_id} 的向量库已构建完成")
 
         except Exception as e:
-            print(f"构建用户 {self.user_id} 向量库时出错: {e}")
+            print(f"构建用户 {user_id} 向量库时出错: {e}")
 
     def get_user_retriever(self) -> VectorStoreRetriever:
-        """获取用户的retriever，如果不存在则返回None"""
-        return self._user_retrievers.get(self.user_id, None)
+        """获取用户的retriever，不在内存中时从磁盘加载，如果不存在则返回None"""
+        entry = self._user_indexes.get(self.user_id)
+        return entry[0] if entry is not None else None
+
+    def user_index_metrics(self) -> dict:
+        """用户向量库缓存的命中率、内存占用和加载耗时"""
+        return self._user_indexes.metrics()
+
+    def _update_user_vector_store(self, changed: List[str], removed: List[str], user_id=None):
+        """只编码新增或覆盖的文件，并删除被覆盖或被删除文件的旧文本块
+
+        在_user_lock内读出、修改并写回用户的向量库，与上传、删除和目录监听互斥。
+        """
+        user_id = user_id or self.user_id
+        with self._user_lock:
+            entry = self._user_indexes.get(user_id)
+            if entry is None:
+                # 向量库已被淘汰且磁盘上的也已删除，按用户文件夹完整构建
+                self.build_user_vector_store(user_id)
+                return
+            user_retriever, file_records = entry
+            vectorstore = user_retriever.vectorstore
+            user_data_path = os.path.join("user_data", user_id)
+
+            stale_ids = []
+            for rel_path in changed + removed:
+                record = file_records.pop(rel_path, None)
+                if record is not None:
+                    stale_ids.extend(record.chunk_ids)
+            existing_ids = set(vectorstore.index_to_docstore_id.values())
+            stale_ids = [i for i in stale_ids if i in existing_ids]
+            if stale_ids and not supports_removal(vectorstore.index):
+                print("当前索引类型不支持删除向量，重建用户向量库")
+                self.build_user_vector_store(user_id)
+                return
+            if stale_ids:
+                vectorstore.delete(stale_ids)
+
+            changed = [
+                rel_path
+                for rel_path in changed
+                if os.path.splitext(rel_path)[1].lower() in FILE_LOADERS
+            ]
+            _, new_records = diff_files(user_data_path, {}, changed)
+            _, file_chunk_ids = self._user_pipeline().run(
+                vectorstore,
+                ingest_files(user_data_path, changed, self._ingest_workers),
+                len(changed),
+                owner=user_id if self._shared_user_index else None,
+            )
+            for rel_path, chunk_ids in file_chunk_ids.items():
+                new_records[rel_path].chunk_ids = chunk_ids
+            file_records.update(new_records)
+            self._user_indexes.put(user_id, user_retriever, file_records)
+            print(
+                f"用户 {user_id} 的向量库已增量更新：编码 {len(changed)} 个文件，"
+                f"删除 {len(stale_ids)} 个旧文本块"
+            )
+
+    def _on_user_data_change(self, rel_paths: List[str]):
+        # 路径的第一级是用户ID
+        by_user: Dict[str, List[str]] = {}
+        for rel_path in rel_paths:
+            user_id, _, path = rel_path.partition("/")
+            by_user.setdefault(user_id, []).append(path)
+        for user_id, paths in by_user.items():
+            self.sync_user_files(user_id, paths)
+
+    def sync_user_files(self, user_id: str, paths: List[str]):
+        """用户文件夹中这些路径发生了变化，只编码内容确实变化的文件；上传接口已处理过的文件不会重复编码"""
+        user_data_path = os.path.join("user_data", user_id)
+        with self._user_lock:
+            entry = self._user_indexes.get(user_id)
+            if not os.path.isdir(user_data_path):
+                if entry is not None:
+                    self._user_indexes.pop(user_id)
+                    print(f"用户文件夹 {user_data_path} 已删除，同时删除其向量库")
+                return
+            if entry is None or "" in paths:
+                # 还没有向量库，或整个用户文件夹被替换
+                if scan_files(user_data_path, FILE_LOADERS):
+                    self.build_user_vector_store(user_id)
+                return
+            _, file_records = entry
+            rel_paths = _rescan(user_data_path, file_records, set(paths))
+            diff, _ = diff_files(user_data_path, file_records, rel_paths)
+            if diff.changed:
+                self._update_user_vector_store(diff.added + diff.modified, diff.removed, user_id)
 
     def upload_user_file(self, file):
         """将用户上传的文件存储到用户的文件夹中"""
@@ -322,6 +569,17 @@ class Retrievemodel(Modelbase):
 
         print(f"文件 {file.name} 已成功上传到用户 {self.user_id} 的文件夹")
 
+        # 已有向量库时只编码这一个文件，否则为用户完整构建一次
+        with self._user_lock:
+            if self._user_indexes.get(self.user_id) is None:
+                self.build_user_vector_store()
+                return
+            try:
+                rel_path = os.path.relpath(file_path, user_data_path).replace(os.sep, "/")
+                self._update_user_vector_store([rel_path], [])
+            except Exception as e:
+                print(f"更新用户 {self.user_id} 向量库时出错: {e}")
+
     # 展示用户已上传的文件
     def list_uploaded_files(self):
         """展示用户文件夹中已经上传的文件"""
@@ -353,13 +611,23 @@ class Retrievemodel(Modelbase):
             if os.path.exists(file_path):
                 os.remove(file_path)
                 print(f"文件 {filename} 已成功删除")
+                # 同时从向量库中删除该文件的文本块
+                with self._user_lock:
+                    if self._user_indexes.get(self.user_id) is not None:
+                        try:
+                            self._update_user_vector_store([], [filename.replace(os.sep, "/")])
+                        except Exception as e:
+                            print(f"更新用户 {self.user_id} 向量库时出错: {e}")
             else:
                 print(f"文件 {filename} 不存在")
         else:
-            # 清空文件夹
-            for file in os.listdir(user_data_path):
-                file_path = os.path.join(user_data_path, file)
-                os.remove(file_path)
+            # 清空文件夹；与上传和目录监听互斥，避免向量库在清空后又被写回
+            with self._user_lock:
+                for file in os.listdir(user_data_path):
+                    file_path = os.path.join(user_data_path, file)
+                    os.remove(file_path)
+                # 文件已全部删除，向量库也随之清空
+                self._user_indexes.pop(self.user_id)
             print(f"用户 {self.user_id} 文件夹已清空")
 
     def view_uploaded_file(self, filename):
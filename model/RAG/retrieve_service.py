@@ -1,12 +1,56 @@
 # 该函数用于对外界提供retreive服务，调用的是retrieve_model 中的接口
 from typing import List
 from model.RAG.retrieve_model import INSTANCE
+from model.RAG.retrieve_cache import RetrievalCache
+from model.RAG.federated import ORIGIN_KEY, KNOWLEDGE_BASE, USER, merge_by_score
+from config.config import Config
 from langchain_core.documents import Document
 
+# 向量库每次增删文本块都会更新版本号，缓存键中带有版本号，知识库重建或用户上传、删除文件后旧结果不会再命中
+CACHE = RetrievalCache(
+    Config.get_instance().get_with_nested_params("model", "embedding", "query-cache-size"),
+    Config.get_instance().get_with_nested_params("model", "embedding", "query-cache-ttl"),
+)
+# 登录用户是否同时检索公共知识库和自己的文件
+FEDERATED = Config.get_instance().get_with_nested_params("model", "embedding", "user-search") == "federated"
+FEDERATED_QUOTA = {
+    KNOWLEDGE_BASE: Config.get_instance().get_with_nested_params("model", "embedding", "federated-quota", "knowledge-base"),
+    USER: Config.get_instance().get_with_nested_params("model", "embedding", "federated-quota", "user"),
+}
+
 def retrieve(query:str) ->List[Document]:
     if INSTANCE.user_id is None:
-        doc = INSTANCE.retriever.invoke(query)
+        retriever = INSTANCE.retriever
+        doc = _with_origin(CACHE.retrieve("knowledge-base", retriever, query), KNOWLEDGE_BASE) if retriever is not None else []
+    elif FEDERATED:
+        doc = _federated_retrieve(query)
     else:
-        doc = INSTANCE.get_user_retriever().invoke(query)
+        user_retriever = INSTANCE.get_user_retriever()
+        doc = _with_origin(CACHE.retrieve(f"user:{INSTANCE.user_id}", user_retriever, query), USER) if user_retriever is not None else []
         
-    return doc
\ No newline at end of file
+    return doc
+
+def _federated_retrieve(query:str) ->List[Document]:
+    # 在公共知识库和当前用户的文件中一起检索，两边都是与问题的余弦相似度，按相似度合并后取前k个，每个来源不超过配额
+    retriever = INSTANCE.retriever
+    user_retriever = INSTANCE.get_user_retriever()
+    if user_retriever is None:
+        return _with_origin(CACHE.retrieve("knowledge-base", retriever, query), KNOWLEDGE_BASE) if retriever is not None else []
+    if retriever is None:
+        # 还没有可用的知识库索引，只检索用户自己的文件
+        return _with_origin(CACHE.retrieve(f"user:{INSTANCE.user_id}", user_retriever, query), USER)
+    # 查询向量只编码一次，两个向量库用同一个向量检索；编码是检索的主要耗时，用户文件的文本块很少，多检索一个向量库只增加很少的耗时
+    vector = CACHE.query_vector(retriever.vectorstore, query)
+    results = {
+        KNOWLEDGE_BASE: CACHE.retrieve("knowledge-base", retriever, query, vector),
+        USER: CACHE.retrieve(f"user:{INSTANCE.user_id}", user_retriever, query, vector),
+    }
+    return merge_by_score(results, retriever.search_kwargs.get("k", 6), FEDERATED_QUOTA)
+
+def _with_origin(docs:List[Document], origin:str) ->List[Document]:
+    for doc in docs:
+        doc.metadata[ORIGIN_KEY] = origin
+    return docs
+
+def cache_metrics() -> dict:
+    return CACHE.metrics()
@@ -0,0 +1,173 @@
+'''对比每个用户一个向量库（per-user）和所有用户共用一个向量库（shared）的内存占用、构建和检索耗时
+
+    python -m model.RAG.tenant_benchmark --users 10000 --chunks-per-user 20
+
+用随机向量和按词频分布生成的随机中文文本构造用户文本块，不需要加载编码模型。
+每种方式在单独的子进程中构建，内存按进程RSS的增量统计（只在Linux上可用），同时给出按estimate_size估算的大小。
+per-user方式下所有用户的向量库都留在内存中，不受user-index-cache-mb限制。
+'''
+import os
+import time
+import argparse
+import multiprocessing
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from model.RAG.chunker import ChunkSpec
+from model.RAG.compact_docstore import CompactDocstore
+from model.RAG.hybrid_store import HybridFAISS
+from model.RAG.user_index_cache import estimate_size
+
+# 随机文本使用的常用汉字数，按1/排名的频率抽样，接近真实文本中常见二元组的倒排链长度
+_VOCAB_SIZE = 3000
+
+
+class _RandomEmbeddings(Embeddings):
+    """只用于满足向量库的构造参数，检索时直接传入查询向量"""
+
+    def __init__(self, dim: int):
+        self._dim = dim
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return np.random.standard_normal((len(texts), self._dim)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return np.random.standard_normal(self._dim).tolist()
+
+
+def _rss_mb() -> Optional[float]:
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def _create_index(index_type: str, dim: int) -> faiss.Index:
+    if index_type == "flat-fp16":
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16)
+    return faiss.IndexFlatL2(dim)
+
+
+class _Corpus(object):
+    def __init__(self, args):
+        self._args = args
+        self._rng = np.random.default_rng(args.seed)
+        self._vocab = np.array([chr(0x4E00 + i * 7) for i in range(_VOCAB_SIZE)])
+        weights = 1.0 / np.arange(1, _VOCAB_SIZE + 1)
+        self._weights = weights / weights.sum()
+
+    def texts(self, count: int, length: int) -> List[str]:
+        chars = self._rng.choice(self._vocab, size=(count, length), p=self._weights)
+        return ["".join(row) for row in chars]
+
+    def vectors(self, count: int) -> np.ndarray:
+        vectors = self._rng.standard_normal((count, self._args.dim)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _run(mode: str, args, queue):
+    corpus = _Corpus(args)
+    embedding = _RandomEmbeddings(args.dim)
+    shared = mode == "shared"
+    stores: Dict[str, HybridFAISS] = {}
+    store = None
+    if shared:
+        store = HybridFAISS(embedding, _create_index(args.index_type, args.dim), CompactDocstore(), {})
+
+    base = _rss_mb()
+    start = time.perf_counter()
+    for u in range(args.users):
+        user_id = f"user{u}"
+        n = args.chunks_per_user
+        texts = corpus.texts(n, args.text_chars)
+        metadatas = [{"source": f"{user_id}/upload.pdf", "page": i // 4} for i in range(n)]
+        if shared:
+            for metadata in metadatas:
+                metadata["owner"] = user_id
+        else:
+            store = HybridFAISS(embedding, _create_index(args.index_type, args.dim), CompactDocstore(), {})
+            stores[user_id] = store
+        store.add_embeddings(
+            zip(texts, corpus.vectors(n).tolist()),
+            metadatas=metadatas,
+            ids=[f"{user_id}-{i}" for i in range(n)],
+        )
+    build_seconds = time.perf_counter() - start
+    rss = _rss_mb()
+    all_stores = [store] if shared else list(stores.values())
+    estimated = sum(estimate_size(s.as_retriever()) for s in all_stores) / 1024 / 1024
+
+    rng = np.random.default_rng(args.seed + 1)
+    queries = corpus.texts(args.queries, 12)
+    vectors = corpus.vectors(args.queries).tolist()
+    latencies = []
+    for query, vector in zip(queries, vectors):
+        user_id = f"user{rng.integers(args.users)}"
+        start = time.perf_counter()
+        if shared:
+            results = store.retrieve_ids(query, vector, args.search_type, k=6, owner=user_id)
+        else:
+            results = stores[user_id].retrieve_ids(query, vector, args.search_type, k=6)
+        latencies.append(time.perf_counter() - start)
+        assert all(id.startswith(user_id + "-") for id, _ in results)
+    latencies = np.array(latencies) * 1000
+
+    queue.put(
+        {
+            "mode": mode,
+            "stores": len(all_stores),
+            "chunks": sum(s.index.ntotal for s in all_stores),
+            "build-s": round(build_seconds, 2),
+            "rss-mb": round(rss - base, 1) if rss is not None else None,
+            "estimated-mb": round(estimated, 1),
+            "p50-ms": round(float(np.percentile(latencies, 50)), 3),
+            "p95-ms": round(float(np.percentile(latencies, 95)), 3),
+            "qps": round(len(latencies) / (latencies.sum() / 1000), 1),
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--chunks-per-user", type=int, default=20)
+    parser.add_argument("--dim", type=int, default=768, help="向量维度，CoRom编码模型为768")
+    parser.add_argument(
+        "--text-chars", type=int, default=None, help="每个文本块的字数，默认与配置中编码的文本块长度一致"
+    )
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--search-type", choices=("similarity", "hybrid"), default="hybrid")
+    parser.add_argument("--index-type", choices=("flat", "flat-fp16"), default="flat")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.text_chars is None:
+        chunk_spec = ChunkSpec.from_config()
+        args.text_chars = chunk_spec.child_size if chunk_spec.splitter_type == "sentence" else chunk_spec.chunk_size
+
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for mode in ("per-user", "shared"):
+        queue = context.Queue()
+        process = context.Process(target=_run, args=(mode, args, queue))
+        process.start()
+        rows.append(queue.get())
+        process.join()
+        print(f"{mode} 完成: {rows[-1]}")
+
+    columns = ["mode", "stores", "chunks", "build-s", "rss-mb", "estimated-mb", "p50-ms", "p95-ms", "qps"]
+    print(
+        f"\n{args.users} 个用户，每人 {args.chunks_per_user} 个 {args.text_chars} 字的文本块，{args.dim} 维，"
+        f"{args.index_type}，{args.search_type} 检索 {args.queries} 次"
+    )
+    print("".join(f"{c:>14}" for c in columns))
+    for row in rows:
+        print("".join(f"{str(row[c]):>14}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+'''多用户共用的向量库：所有用户的文本块存放在同一个FAISS向量库中，metadata["owner"]标记所属用户，检索时只在该用户的文本块中进行
+
+每个用户一个向量库时，用户很多而每个用户的文件很少，大量小索引各自带有固定开销，每个用户也要单独构建和加载。
+共用一个向量库后只有一份索引、docstore和BM25索引，用户上传文件时直接增量写入。
+'''
+import os
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStoreRetriever
+
+from model.RAG.file_manifest import FileRecord
+from model.RAG.hybrid_store import HybridFAISS
+from model.RAG.index_factory import IndexSpec
+from model.RAG.index_store import save_index, load_index, read_file_records
+from model.RAG.user_index_cache import estimate_size
+
+# 共用向量库在用户向量库目录下的子目录名
+SHARED_DIR = "_shared"
+# 按用户过滤的检索只对该用户的向量精确计算距离，倒排和图索引用不上，只保留精确检索的索引类型
+_FILTERABLE_INDEX_TYPES = ("flat", "flat-fp16")
+
+
+class TenantIndex(object):
+    """接口与UserIndexCache相同：按用户返回 (只检索该用户文本块的retriever, 该用户的文件清单)"""
+
+    def __init__(
+        self,
+        spill_path: str,
+        embedding: Embeddings,
+        manifest: dict,
+        index_spec: IndexSpec,
+        as_retriever: Callable[..., VectorStoreRetriever],
+    ):
+        self._path = os.path.join(spill_path, SHARED_DIR)
+        self._embedding = embedding
+        if index_spec.index_type not in _FILTERABLE_INDEX_TYPES:
+            print(f"多用户共用向量库不使用 {index_spec.index_type} 索引，改用flat")
+            index_spec = IndexSpec("flat")
+        self.index_spec = index_spec
+        self._manifest = {k: v for k, v in manifest.items() if not k.startswith("index-")}
+        self._manifest.update(index_spec.manifest())
+        self._as_retriever = as_retriever
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._store: Optional[HybridFAISS] = None
+        # 用户ID -> {相对用户文件夹的路径: 文件记录}
+        self._records: Dict[str, Dict[str, FileRecord]] = {}
+        self._dirty = False
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        self._store = load_index(self._path, self._embedding, self._manifest, self.index_spec)
+        if self._store is None:
+            return
+        # 磁盘上的文件清单以"用户ID/路径"为键
+        for key, record in read_file_records(self._path).items():
+            user_id, _, rel_path = key.partition("/")
+            self._records.setdefault(user_id, {})[rel_path] = record
+        print(f"已加载多用户共用向量库，{len(self._records)} 个用户，共 {self._store.index.ntotal} 个文本块")
+
+    @property
+    def store(self) -> Optional[HybridFAISS]:
+        """共用的向量库，还没有任何用户文件时为None"""
+        with self._lock:
+            self._ensure_loaded()
+            return self._store
+
+    def get(
+        self, user_id: str
+    ) -> Optional[Tuple[VectorStoreRetriever, Dict[str, FileRecord]]]:
+        with self._lock:
+            self._ensure_loaded()
+            records = self._records.get(user_id)
+            if records is None or self._store is None:
+                return None
+            return self._as_retriever(self._store, owner=user_id), records
+
+    def put(
+        self,
+        user_id: str,
+        retriever: VectorStoreRetriever,
+        file_records: Dict[str, FileRecord],
+    ):
+        """记录用户的文件清单，文本块已由调用方写入共用向量库"""
+        with self._lock:
+            self._store = retriever.vectorstore
+            self._records[user_id] = file_records
+            self._dirty = True
+
+    def pop(self, user_id: str):
+        """从共用向量库中删除该用户的全部文本块"""
+        with self._lock:
+            self._ensure_loaded()
+            records = self._records.pop(user_id, None)
+            if records is None or self._store is None:
+                return
+            existing_ids = set(self._store.index_to_docstore_id.values())
+            stale_ids = [
+                id for record in records.values() for id in record.chunk_ids if id in existing_ids
+            ]
+            if stale_ids:
+                self._store.delete(stale_ids)
+            self._dirty = True
+
+    def flush(self):
+        """把修改过的共用向量库写到磁盘，进程退出前调用"""
+        with self._lock:
+            if not self._dirty or self._store is None:
+                return
+            records = {
+                f"{user_id}/{rel_path}": record
+                for user_id, user_records in self._records.items()
+                for rel_path, record in user_records.items()
+            }
+            save_index(self._store, self._path, self._manifest, records)
+            self._dirty = False
+
+    def metrics(self) -> dict:
+        with self._lock:
+            self._ensure_loaded()
+            if self._store is None:
+                return {"users": len(self._records), "chunks": 0, "memory-mb": 0.0}
+            return {
+                "users": len(self._records),
+                "chunks": self._store.index.ntotal,
+                "memory-mb": round(estimate_size(self._store.as_retriever()) / 1024 / 1024, 2),
+            }
@@ -0,0 +1,156 @@
+'''用户向量库缓存：内存占用超过预算时把最久未使用的用户向量库写到磁盘，下次访问时再加载'''
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStoreRetriever
+
+from model.RAG.file_manifest import FileRecord
+from model.RAG.index_factory import IndexSpec
+from model.RAG.index_store import save_index, load_index, read_file_records, remove_index
+
+
+def estimate_size(retriever: VectorStoreRetriever) -> int:
+    """估算一个FAISS向量库占用的内存：向量编码本身加上文本块（及父块）内容和关键词索引"""
+    vectorstore = retriever.vectorstore
+    index = vectorstore.index
+    # 压缩索引（fp16、pq）每个向量的编码更短，没有code_size的索引按float32估算
+    size = index.ntotal * getattr(index, "code_size", index.d * 4)
+    return size + vectorstore.docstore.nbytes + vectorstore.parents.nbytes + vectorstore.lexical.nbytes
+
+
+class _Entry(object):
+    def __init__(self, retriever, file_records, size, dirty):
+        self.retriever = retriever
+        self.file_records = file_records
+        self.size = size
+        self.dirty = dirty  # 内存中的向量库是否比磁盘上的新
+
+
+class UserIndexCache(object):
+    """按用户缓存 (retriever, 文件清单)，超出内存预算时按LRU淘汰到磁盘"""
+
+    def __init__(
+        self,
+        spill_path: str,
+        memory_budget_mb: int,
+        embedding: Embeddings,
+        manifest: dict,
+        index_spec: IndexSpec,
+        as_retriever: Callable[..., VectorStoreRetriever],
+    ):
+        self._spill_path = spill_path
+        self._budget = memory_budget_mb * 1024 * 1024
+        self._embedding = embedding
+        self._manifest = manifest
+        self._index_spec = index_spec
+        self._as_retriever = as_retriever
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._memory = 0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.evictions = 0
+
+    def _user_path(self, user_id: str) -> str:
+        return os.path.join(self._spill_path, user_id)
+
+    def get(
+        self, user_id: str
+    ) -> Optional[Tuple[VectorStoreRetriever, Dict[str, FileRecord]]]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry.retriever, entry.file_records
+
+            self.misses += 1
+            user_path = self._user_path(user_id)
+            if not os.path.exists(user_path):
+                return None
+
+            start = time.perf_counter()
+            vectorstore = load_index(
+                user_path, self._embedding, self._manifest, self._index_spec
+            )
+            if vectorstore is None:
+                return None
+            retriever = self._as_retriever(vectorstore)
+            file_records = read_file_records(user_path)
+            self.loads += 1
+            self.load_seconds += time.perf_counter() - start
+
+            self._insert(user_id, _Entry(retriever, file_records, estimate_size(retriever), False))
+            return retriever, file_records
+
+    def put(
+        self,
+        user_id: str,
+        retriever: VectorStoreRetriever,
+        file_records: Dict[str, FileRecord],
+    ):
+        """放入新建或修改过的向量库，它会在被淘汰时写回磁盘"""
+        with self._lock:
+            old = self._entries.pop(user_id, None)
+            if old is not None:
+                self._memory -= old.size
+            self._insert(user_id, _Entry(retriever, file_records, estimate_size(retriever), True))
+
+    def pop(self, user_id: str):
+        """从内存和磁盘中同时删除用户的向量库"""
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self._memory -= entry.size
+            remove_index(self._user_path(user_id))
+
+    def _insert(self, user_id: str, entry: _Entry):
+        self._entries[user_id] = entry
+        self._memory += entry.size
+        # 至少保留刚放入的这一个
+        while self._memory > self._budget and len(self._entries) > 1:
+            evict_id, evicted = self._entries.popitem(last=False)
+            self._memory -= evicted.size
+            if evicted.dirty:
+                save_index(
+                    evicted.retriever.vectorstore,
+                    self._user_path(evict_id),
+                    self._manifest,
+                    evicted.file_records,
+                )
+            self.evictions += 1
+
+    def flush(self):
+        """把内存中所有修改过的向量库写到磁盘，进程退出前调用"""
+        with self._lock:
+            for user_id, entry in self._entries.items():
+                if entry.dirty:
+                    save_index(
+                        entry.retriever.vectorstore,
+                        self._user_path(user_id),
+                        self._manifest,
+                        entry.file_records,
+                    )
+                    entry.dirty = False
+
+    def metrics(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "users-in-memory": len(self._entries),
+                "memory-mb": round(self._memory / 1024 / 1024, 2),
+                "budget-mb": round(self._budget / 1024 / 1024, 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit-ratio": round(self.hits / total, 4) if total else 0.0,
+                "disk-loads": self.loads,
+                "avg-load-ms": round(self.load_seconds / self.loads * 1000, 2) if self.loads else 0.0,
+                "evictions": self.evictions,
+            }
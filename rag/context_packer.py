@@ -0,0 +1,121 @@
+'''按token预算拼接检索到的资料：按相关度顺序填充，超出预算的文本块在句子边界截断，并标注简短的来源'''
+import os
+import re
+from typing import List
+
+from langchain_core.documents import Document
+
+from config.config import Config
+from model.RAG.federated import ORIGIN_KEY, USER
+
+SEPARATOR = "\n-------------分割线--------------\n"
+# 按中英文句末标点和换行切分句子，标点保留在句子末尾
+_SENTENCE_END = re.compile(r"(?<=[。！？；!?;\n])|(?<=\. )")
+# 剩余预算少于这么多token时不再放入新的文本块，避免只放进半句话
+_MIN_CHUNK_TOKENS = 32
+
+
+def _is_cjk(ch: str) -> bool:
+    return "\u4e00" <= ch <= "\u9fff" or "\u3000" <= ch <= "\u303f" or "\uff00" <= ch <= "\uffef"
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中文字符和全角标点各约1个token，其他字符约4个一个token
+
+    不依赖具体模型的分词器，对常见的中文大模型偏保守。
+    """
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """保留开头尽量多的完整句子；第一句就超出预算时按字符截断"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    kept, used = [], 0
+    for sentence in _SENTENCE_END.split(text):
+        tokens = estimate_tokens(sentence)
+        if used + tokens > max_tokens:
+            break
+        kept.append(sentence)
+        used += tokens
+    if kept:
+        return "".join(kept).rstrip()
+    # 逐字累计token数，找到超出预算的第一个字，与estimate_tokens的估算方式一致
+    cjk = other = 0
+    for end, ch in enumerate(text):
+        if _is_cjk(ch):
+            cjk += 1
+        else:
+            other += 1
+        if cjk + (other + 3) // 4 > max_tokens:
+            return text[:end]
+    return text
+
+
+def source_tag(index: int, doc: Document) -> str:
+    """如 [1] 糖尿病指南.pdf 第3页，用户上传的文件标注为 [1] 用户文件 体检报告.pdf"""
+    tag = f"[{index}]"
+    if doc.metadata.get(ORIGIN_KEY) == USER:
+        tag += " 用户文件"
+    source = doc.metadata.get("source")
+    if source:
+        tag += f" {os.path.basename(str(source))}"
+        # 近似重复的文本块合并后记录了所有来源文件
+        sources = doc.metadata.get("sources") or []
+        if len(sources) > 1:
+            tag += f" 等{len(sources)}个文件"
+    page = doc.metadata.get("page")
+    if isinstance(page, int):
+        tag += f" 第{page + 1}页"
+    # 结构化数据（JSONL、CSV）的文本块来自文件中的一行记录
+    row = doc.metadata.get("row")
+    if isinstance(row, int):
+        tag += f" 第{row + 1}条"
+    return tag
+
+
+class ContextPacker(object):
+    """把检索结果拼成提示词中的资料文本，总长度不超过max_tokens"""
+
+    def __init__(self, max_tokens: int = 3000, max_tokens_per_chunk: int = 0):
+        self._max_tokens = max_tokens
+        self._max_tokens_per_chunk = max_tokens_per_chunk
+
+    @classmethod
+    def from_config(cls) -> "ContextPacker":
+        conf = Config.get_instance().get_with_nested_params("model", "context")
+        return cls(
+            max_tokens=conf.get("max-tokens", 3000),
+            max_tokens_per_chunk=conf.get("max-tokens-per-chunk", 0),
+        )
+
+    def pack(self, docs: List[Document]) -> str:
+        parts = []
+        remaining = self._max_tokens
+        separator_tokens = estimate_tokens(SEPARATOR)
+        for doc in docs:
+            tag = source_tag(len(parts) + 1, doc)
+            budget = remaining - estimate_tokens(tag) - 1
+            if parts:
+                budget -= separator_tokens
+            if self._max_tokens_per_chunk:
+                budget = min(budget, self._max_tokens_per_chunk)
+            if budget < _MIN_CHUNK_TOKENS:
+                break
+            text = trim_to_tokens(doc.page_content.strip(), budget)
+            if not text:
+                continue
+            part = f"{tag}\n{text}"
+            remaining -= estimate_tokens(part) + (separator_tokens if parts else 0)
+            parts.append(part)
+
+        context = SEPARATOR.join(parts)
+        print(
+            f"检索资料：使用 {len(parts)}/{len(docs)} 个文本块，"
+            f"约 {self._max_tokens - remaining}/{self._max_tokens} tokens"
+        )
+        return context
+
+
+INSTANCE = ContextPacker.from_config()
@@ -14,6 +14,10 @@ def invoke(question: str, history: List[List]) -> Stream[ChatCompletionChunk]:
     except Exception as e:
         _context = ""
 
+    if not _context:
+        # 没有检索结果达到相似度阈值（或检索失败）时不附带资料，直接回答
+        return Clientfactory().get_client().chat_with_ai_stream(question, history)
+
     prompt = f"请根据搜索到的文件信息\n{_context}\n 回答问题：\n{question}"
     response = Clientfactory().get_client().chat_with_ai_stream(prompt)
 
@@ -1,12 +1,16 @@
 from typing import List,Tuple
 from langchain_core.documents import Document
 from model.RAG.retrieve_service import retrieve
+from rag.context_packer import INSTANCE as CONTEXT_PACKER
 
 def format_docs(docs:List[Document]):
-    return "\n-------------分割线--------------\n".join(doc.page_content for doc in docs)
+    # 按token预算拼接，超出部分在句子边界截断
+    return CONTEXT_PACKER.pack(docs)
 
 def retrieve_docs(question:str)->Tuple[List[Document],str]:
     docs = retrieve(question) # 这里的到的是文件
+    # 打印每个结果与问题的相似度，用于调整相似度阈值
+    print("检索相似度: " + ", ".join(f"{doc.metadata.get('score')}" for doc in docs))
     _context = format_docs(docs) # 这里处理成文本
     print(_context)
     return (docs,_context)